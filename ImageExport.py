@@ -0,0 +1,113 @@
+import os
+import threading
+import multiprocessing as mp
+import cv2
+import numpy as np
+from ImageStore import read_image
+from OcrEngine import JobCancelled
+
+# Число процессов отрисовки (0 - по числу ядер) и настройки кодирования по умолчанию
+EXPORT_PROCESSES = int(os.environ.get("LOCMAP_EXPORT_PROCESSES", 0))
+IMAGE_FORMATS = (".png", ".jpg", ".webp")
+EXPORT_QUALITY = int(os.environ.get("LOCMAP_EXPORT_QUALITY", 90))
+PNG_COMPRESSION = int(os.environ.get("LOCMAP_PNG_COMPRESSION", 3))
+
+
+def draw_results(cvimg, ocr_results, labels=False):
+    # Рамки результатов и, по желанию, распознанный текст над каждой рамкой
+    if ocr_results is None or len(ocr_results) == 0:
+        return cvimg
+    # Описанные прямоугольники, как на холсте
+    bboxes = np.round(ocr_results.bboxes).astype(np.int32).tolist()
+    for x0, y0, x1, y1 in bboxes:
+        cv2.rectangle(cvimg, (x0, y0), (x1, y1), (0, 0, 255), 2)
+    if labels:
+        for (x0, y0, x1, y1), text in zip(bboxes, ocr_results.texts):
+            scale = max(0.4, (y1 - y0) / 30)
+            cv2.putText(cvimg, text, (x0, max(y0 - 4, 12)), cv2.FONT_HERSHEY_SIMPLEX, scale,
+                        (0, 0, 255), max(1, round(scale * 2)), cv2.LINE_AA)
+    return cvimg
+
+
+def encode_params(ext, quality=EXPORT_QUALITY, png_compression=PNG_COMPRESSION):
+    if ext == ".jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if ext == ".webp":
+        # Качество выше 100 - WebP без потерь
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    return [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+
+
+def output_paths(imgs_pathsList, directory, ext):
+    # <имя>_ocrRes<ext>; одинаковые имена из разных папок получают номер
+    used = set()
+    out_paths = []
+    for Imgpath in imgs_pathsList:
+        stem = f"{os.path.splitext(os.path.basename(Imgpath))[0]}_ocrRes"
+        name, n = stem + ext, 1
+        while name.lower() in used:
+            name = f"{stem}_{n}{ext}"
+            n += 1
+        used.add(name.lower())
+        out_paths.append(os.path.join(directory, name))
+    return out_paths
+
+
+def _export_task(task):
+    Imgpath, ocr_results, out_path, params, labels = task
+    try:
+        cvimg = read_image(Imgpath)
+        if cvimg is None:
+            raise ValueError("изображение не читается")
+        ok, data = cv2.imencode(os.path.splitext(out_path)[1], draw_results(cvimg, ocr_results, labels), params)
+        if not ok:
+            raise ValueError("ошибка кодирования")
+        data.tofile(out_path)
+        return Imgpath, out_path
+    except Exception as e:
+        print("Ошибка сохранения изображения", Imgpath, e)
+        return Imgpath, None
+
+
+def export_images(imgs_pathsList, results_dic, directory, ext=".png", quality=EXPORT_QUALITY,
+                  png_compression=PNG_COMPRESSION, labels=True, processes=EXPORT_PROCESSES, control=None):
+    # Каждое изображение рисуется со своими результатами и кодируется в отдельном процессе.
+    # Выдаёт (путь изображения, путь файла или None) по мере готовности. С control задачи
+    # подаются не более чем по две на процесс, и отмена останавливает подачу
+    ext = ext.lower()
+    if ext not in IMAGE_FORMATS:
+        raise ValueError(f"Неизвестный формат изображений: {ext}")
+    params = encode_params(ext, quality, png_compression)
+    tasks = [(Imgpath, results_dic.get(Imgpath), out_path, params, labels)
+             for Imgpath, out_path in zip(imgs_pathsList, output_paths(imgs_pathsList, directory, ext))]
+    processes = max(1, min(processes or os.cpu_count() or 1, len(tasks)))
+    if processes == 1:
+        for task in tasks:
+            if control is not None:
+                try:
+                    control.checkpoint()
+                except JobCancelled:
+                    return
+            yield _export_task(task)
+        return
+    slots = threading.Semaphore(2 * processes)
+
+    def feed():
+        for task in tasks:
+            slots.acquire()
+            if control is not None:
+                try:
+                    control.checkpoint()
+                except JobCancelled:
+                    return
+            yield task
+
+    pool = mp.get_context("spawn").Pool(processes)
+    try:
+        for result in pool.imap_unordered(_export_task, feed(), chunksize=1):
+            slots.release()
+            yield result
+    finally:
+        slots.release(len(tasks))
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,253 @@
+import os
+import abc
+import struct
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# Предельный объём декодированных изображений в памяти, МБ
+IMAGE_CACHE_MB = int(os.environ.get("LOCMAP_IMAGE_CACHE_MB", 1024))
+# Файлы больше этого размера, МБ, не читаются в память целиком, а отображаются (mmap)
+MMAP_MIN_MB = int(os.environ.get("LOCMAP_MMAP_MIN_MB", 64))
+
+
+def read_bytes(path):
+    # Содержимое файла; большие файлы отображаются в память и читаются по мере обращения
+    if os.path.getsize(path) >= MMAP_MIN_MB * 1024 * 1024:
+        return np.memmap(path, dtype=np.uint8, mode='r')
+    return np.fromfile(path, dtype=np.uint8)
+
+
+def decode_image(data):
+    return cv2.imdecode(data, 1)
+
+
+def read_image(path):
+    return decode_image(read_bytes(path))
+
+
+def image_size(path):
+    # (ширина, высота) из заголовка файла, без декодирования пикселей
+    source = open_source(path)
+    if source is not None:
+        return source.width, source.height
+    try:
+        with Image.open(path) as im:
+            return im.size
+    except Exception:
+        Ih, Iw = read_image(path).shape[:2]
+        return Iw, Ih
+
+
+class ImageCache:
+    # Декодированные изображения, общие для распознавания и просмотра;
+    # при превышении предела вытесняются давно не использованные
+    def __init__(self, max_mb=IMAGE_CACHE_MB):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.nbytes = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, path):
+        with self._lock:
+            return path in self._images
+
+    def get(self, path, data=None):
+        # data - уже прочитанное содержимое файла, чтобы не читать его повторно
+        with self._lock:
+            img = self._images.get(path)
+            if img is not None:
+                self._images.move_to_end(path)
+                return img
+        img = decode_image(read_bytes(path) if data is None else data)
+        if img is not None:
+            self.put(path, img)
+        return img
+
+    def put(self, path, img):
+        with self._lock:
+            old = self._images.pop(path, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            if img.nbytes > self.max_bytes:
+                return
+            self._images[path] = img
+            self.nbytes += img.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._images.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def discard(self, path):
+        with self._lock:
+            old = self._images.pop(path, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+
+def to_bgr(pixels):
+    # Окно растра (H, W) или (H, W, C) в RGB -> BGR uint8, как после cv2.imdecode
+    if pixels.ndim == 2:
+        return cv2.cvtColor(np.ascontiguousarray(pixels), cv2.COLOR_GRAY2BGR)
+    return np.ascontiguousarray(pixels[:, :, 2::-1])
+
+
+class RasterSource(abc.ABC):
+    # Изображение, из которого читаются только нужные окна. shape как у массива,
+    # поэтому источник можно передавать туда, где ожидается изображение целиком
+    width = height = 0
+
+    @property
+    def shape(self):
+        return self.height, self.width, 3
+
+    @abc.abstractmethod
+    def read(self, x0, y0, x1, y1):
+        # Окно [x0, x1) x [y0, y1) в BGR uint8, обрезанное по границам изображения
+        pass
+
+    def full(self):
+        return self.read(0, 0, self.width, self.height)
+
+    def clip(self, x0, y0, x1, y1):
+        return (max(0, int(x0)), max(0, int(y0)), min(self.width, int(x1)), min(self.height, int(y1)))
+
+
+class ArraySource(RasterSource):
+    # Уже декодированное изображение
+    def __init__(self, img):
+        self.img = img
+        self.height, self.width = img.shape[:2]
+
+    def read(self, x0, y0, x1, y1):
+        x0, y0, x1, y1 = self.clip(x0, y0, x1, y1)
+        return self.img[y0:y1, x0:x1]
+
+
+class BmpSource(RasterSource):
+    # Несжатый BMP 24/32 бит: строки пикселей отображаются в память как есть
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            header = file.read(66)
+        if len(header) < 54 or header[:2] != b'BM':
+            raise ValueError("не BMP")
+        offset, = struct.unpack_from("<I", header, 10)
+        width, height, _, bitcount, compression = struct.unpack_from("<iiHHI", header, 18)
+        # BI_BITFIELDS допускается только с обычным порядком байтов B, G, R
+        bitfields = compression == 3 and bitcount == 32 and len(header) == 66 and \
+            struct.unpack_from("<III", header, 54) == (0xFF0000, 0xFF00, 0xFF)
+        if not (compression == 0 and bitcount in (24, 32) or bitfields):
+            raise ValueError("сжатый или палитровый BMP")
+        self.width, self.height = width, abs(height)
+        self.bottom_up = height > 0
+        self.bpp = bitcount // 8
+        row_size = (bitcount * width + 31) // 32 * 4
+        self.rows = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(self.height, row_size))
+
+    def read(self, x0, y0, x1, y1):
+        x0, y0, x1, y1 = self.clip(x0, y0, x1, y1)
+        if self.bottom_up:
+            rows = self.rows[self.height - y1:self.height - y0][::-1]
+        else:
+            rows = self.rows[y0:y1]
+        pixels = rows[:, x0 * self.bpp:x1 * self.bpp].reshape(y1 - y0, x1 - x0, self.bpp)
+        return np.ascontiguousarray(pixels[:, :, :3])
+
+
+class TiffSource(RasterSource):
+    # TIFF: несжатый отображается в память, сжатый по фрагментам или полосам
+    # декодирует только те фрагменты, которые пересекают окно
+    def __init__(self, path):
+        if tifffile is None:
+            raise ValueError("tifffile не установлен")
+        self.tif = tifffile.TiffFile(path)
+        self.page = page = self.tif.pages[0]
+        if page.dtype != np.uint8 or page.planarconfig != 1 or page.samplesperpixel == 2:
+            raise ValueError("неподдерживаемый формат TIFF")
+        # Остальные цветовые модели (CMYK, YCbCr, Lab...) читает cv2.imdecode
+        photometric = int(page.photometric)
+        rgb = photometric == tifffile.PHOTOMETRIC.RGB
+        if rgb != (page.samplesperpixel >= 3) or photometric not in (
+                tifffile.PHOTOMETRIC.RGB, tifffile.PHOTOMETRIC.MINISBLACK,
+                tifffile.PHOTOMETRIC.MINISWHITE, tifffile.PHOTOMETRIC.PALETTE):
+            raise ValueError(f"неподдерживаемая цветовая модель TIFF: {photometric}")
+        self.inverted = photometric == tifffile.PHOTOMETRIC.MINISWHITE
+        self.palette = None
+        if photometric == tifffile.PHOTOMETRIC.PALETTE:
+            # Палитра TIFF 16-битная: (3, 2**bits) -> таблица (256, 3) RGB uint8
+            colormap = np.asarray(page.colormap).reshape(3, -1)
+            if colormap.max() > 255:
+                colormap = colormap >> 8
+            self.palette = np.zeros((256, 3), dtype=np.uint8)
+            self.palette[:colormap.shape[1]] = colormap.T[:256]
+        self.height, self.width = page.imagelength, page.imagewidth
+        self.pixels = tifffile.memmap(path, page=0, mode='r') if page.is_memmappable else None
+        if page.is_tiled:
+            self.segment = (page.tilewidth, page.tilelength)
+        else:
+            self.segment = (self.width, page.rowsperstrip or self.height)
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        if getattr(self, 'tif', None) is not None:
+            self.tif.close()
+
+    def _to_bgr(self, pixels):
+        if self.palette is not None:
+            pixels = self.palette[pixels]
+        elif self.inverted:
+            pixels = 255 - pixels
+        return to_bgr(pixels)
+
+    def read(self, x0, y0, x1, y1):
+        x0, y0, x1, y1 = self.clip(x0, y0, x1, y1)
+        if self.pixels is not None:
+            return self._to_bgr(self.pixels[y0:y1, x0:x1, :3] if self.pixels.ndim == 3 else self.pixels[y0:y1, x0:x1])
+        sw, sh = self.segment
+        per_row = -(-self.width // sw)
+        samples = self.page.samplesperpixel
+        out = np.zeros((y1 - y0, x1 - x0, samples), dtype=np.uint8)
+        fh = self.tif.filehandle
+        for sy in range(y0 // sh, -(-y1 // sh)):
+            for sx in range(x0 // sw, -(-x1 // sw)):
+                index = sy * per_row + sx
+                # Файл общий для потоков просмотра и распознавания
+                with self._lock:
+                    fh.seek(self.page.dataoffsets[index])
+                    data = fh.read(self.page.databytecounts[index])
+                segment = self.page.decode(data, index, jpegtables=self.page.jpegtables)[0]
+                segment = segment.reshape(segment.shape[-3:])
+                gx, gy = sx * sw, sy * sh
+                ax0, ay0 = max(x0, gx), max(y0, gy)
+                ax1, ay1 = min(x1, gx + segment.shape[1]), min(y1, gy + segment.shape[0])
+                out[ay0 - y0:ay1 - y0, ax0 - x0:ax1 - x0] = segment[ay0 - gy:ay1 - gy, ax0 - gx:ax1 - gx]
+        return self._to_bgr(out[:, :, :3] if samples >= 3 else out[:, :, 0])
+
+
+def open_source(path):
+    # Источник с чтением окон для несжатых BMP и TIFF (любых, если есть tifffile);
+    # None - формат читается только целиком через cv2.imdecode
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext == '.bmp':
+            return BmpSource(path)
+        if ext in ('.tif', '.tiff'):
+            return TiffSource(path)
+    except (ValueError, OSError) as e:
+        print("Изображение будет прочитано целиком:", path, e)
+    return None
+
+
+def as_source(img):
+    return img if isinstance(img, RasterSource) else ArraySource(img)
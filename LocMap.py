@@ -1,20 +1,54 @@
 import os
 import sys
-import cv2
-import numpy as np
+import time
+import threading
+import itertools
+from collections import OrderedDict
 from PyQt6.QtWidgets import (QMainWindow, QApplication, QFileDialog,
                                         QWidget, QHBoxLayout, QScrollArea, QDialog, 
                                         QMessageBox, QVBoxLayout, QProgressBar, 
-                                        QDialogButtonBox)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal
-from PyQt6.QtGui import QPixmap, QImage, QPainter, QCursor
-from paddleocr import PaddleOCR
+                                        QDialogButtonBox, QPushButton, QComboBox, QSpinBox,
+                                        QLineEdit, QFormLayout, QLabel)
+from PyQt6.QtCore import Qt, QThread, QTimer, QSize, pyqtSignal, QRectF
+from PyQt6.QtGui import QPixmap, QImage, QPainter, QCursor, QShortcut, QKeySequence, QPen, QColor
 import Index
+from OcrEngine import (create_ocr, warmup, ocr_image, rerecognize, ocr_region, replace_region, JobControl, JobCancelled,
+                       REC_MODEL_DIR, MAX_TEXT_LENGTH, REC_BATCH_IMAGES, ROI_UPSCALE)
+from OcrPool import OcrPool, DEFAULT_PROCESSES, DEFAULT_THREADS
+from OcrCache import OcrCache, CACHE_MAX_MB
+from ImageStore import ImageCache, image_size, open_source
+from OcrPipeline import OcrPipeline
+from OcrResults import ImageResults
+from OcrExport import write_results, read_results, EXPORT_FORMATS
+from OcrSession import save_session, load_session, copy_results, SESSION_EXTENSION
+from ImageExport import export_images, IMAGE_FORMATS, EXPORT_QUALITY
+from SpatialIndex import BoxIndex
+from TileRenderer import TilePyramid, TileLoader, to_qimage, PYRAMID_MIN_SIDE, TILE_CACHE
 
 __appname__ = "LocMap"
+# Отсчёт времени до первой отрисовки окна
+_START_TIME = time.perf_counter()
 BB = QDialogButtonBox
+# Сколько соседних изображений готовить заранее и предельный объём готовых изображений, МБ
+PREFETCH_WINDOW = int(os.environ.get("LOCMAP_PREFETCH", 2))
+PREFETCH_MB = int(os.environ.get("LOCMAP_PREFETCH_MB", 512))
+# Показывать изображения по мере распознавания, без модального окна
+STREAM_RESULTS = os.environ.get("LOCMAP_STREAM", "1") != "0"
+# Конвейер стадий распознавания в одном процессе
+USE_PIPELINE = os.environ.get("LOCMAP_OCR_PIPELINE", "1") != "0"
+# На каком расстоянии от рамки, в пикселях экрана, щелчок ещё выбирает её
+HIT_RADIUS = 8
+# Готовые результаты образца 172117.png
+SAMPLE_RESULTS = ImageResults.from_list([[[[496.0, 1.0], [528.0, 6.0], [525.0, 26.0], [493.0, 22.0]], ('11.8', 0.9021782875061035)], [[[719.0, 0.0], [753.0, 4.0], [749.0, 25.0], [715.0, 17.0]], ('12.4', 0.9965363144874573)], [[[101.0, 26.0], [135.0, 33.0], [131.0, 56.0], [97.0, 50.0]], ('11.6', 0.9851365089416504)], [[[236.0, 30.0], [271.0, 36.0], [268.0, 56.0], [233.0, 50.0]], ('12.4', 0.9943134188652039)], [[[403.0, 28.0], [428.0, 28.0], [428.0, 49.0], [403.0, 49.0]], ('12', 0.9996165037155151)], [[[14.0, 69.0], [45.0, 73.0], [42.0, 96.0], [10.0, 91.0]], ('11.7', 0.9524601101875305)], [[[647.0, 63.0], [683.0, 70.0], [680.0, 92.0], [643.0, 86.0]], ('12.2', 0.9974004626274109)], [[[772.0, 79.0], [806.0, 85.0], [802.0, 106.0], [768.0, 100.0]], ('12.6', 0.9969339370727539)], [[[321.0, 109.0], [346.0, 109.0], [346.0, 131.0], [321.0, 131.0]], ('12', 0.9994945526123047)], [[[505.0, 106.0], [531.0, 106.0], [531.0, 128.0], [505.0, 128.0]], ('12', 0.9994453191757202)], [[[131.0, 129.0], [164.0, 129.0], [164.0, 153.0], [131.0, 153.0]], ('11.7', 0.9800257682800293)], [[[400.0, 142.0], [432.0, 147.0], [429.0, 168.0], [397.0, 164.0]], ('11.7', 0.9259808659553528)], [[[574.0, 143.0], [611.0, 146.0], [610.0, 169.0], [572.0, 166.0]], ('12.4', 0.9987472891807556)], [[[255.0, 170.0], [277.0, 170.0], [277.0, 188.0], [255.0, 188.0]], ('12', 0.9993113279342651)], [[[705.0, 166.0], [740.0, 172.0], [736.0, 196.0], [701.0, 190.0]], ('12.6', 0.9992864727973938)], [[[831.0, 161.0], [865.0, 168.0], [861.0, 189.0], [828.0, 183.0]], ('12.6', 0.9958174228668213)], [[[505.0, 218.0], [530.0, 218.0], [530.0, 239.0], [505.0, 239.0]], ('12', 0.9995774030685425)], [[[602.0, 230.0], [636.0, 236.0], [632.0, 258.0], [598.0, 252.0]], ('12.4', 0.9930214285850525)], [[[27.0, 238.0], [59.0, 246.0], [54.0, 266.0], [23.0, 258.0]], ('11.8', 0.8212630748748779)], [[[337.0, 237.0], [371.0, 246.0], [366.0, 266.0], [332.0, 257.0]], ('12.4', 0.9973967671394348)], [[[753.0, 249.0], [785.0, 252.0], [783.0, 273.0], [751.0, 270.0]], ('12.8', 0.9726212024688721)], [[[247.0, 296.0], [282.0, 303.0], [278.0, 326.0], [243.0, 320.0]], ('12.2', 0.9990389943122864)], [[[112.0, 309.0], [145.0, 315.0], [141.0, 336.0], [108.0, 330.0]], ('11.8', 0.8621516227722168)], [[[690.0, 308.0], [725.0, 314.0], [721.0, 337.0], [685.0, 331.0]], ('12.8', 0.9702611565589905)], [[[822.0, 311.0], [857.0, 317.0], [853.0, 340.0], [818.0, 334.0]], ('12.8', 0.9512612819671631)], [[[432.0, 330.0], [468.0, 335.0], [464.0, 360.0], [429.0, 355.0]], ('12.2', 0.998501718044281)], [[[530.0, 326.0], [564.0, 330.0], [562.0, 354.0], [528.0, 351.0]], ('12.2', 0.9964764714241028)], [[[311.0, 361.0], [347.0, 367.0], [343.0, 390.0], [307.0, 384.0]], ('12.5', 0.9912349581718445)], [[[160.0, 387.0], [195.0, 387.0], [195.0, 412.0], [160.0, 412.0]], ('12.2', 0.9976766109466553)], [[[47.0, 409.0], [72.0, 412.0], [70.0, 434.0], [45.0, 432.0]], ('12', 0.9998159408569336)], [[[755.0, 405.0], [789.0, 408.0], [787.0, 432.0], [752.0, 429.0]], ('12.8', 0.9887421131134033)], [[[509.0, 431.0], [545.0, 438.0], [540.0, 462.0], [505.0, 456.0]], ('12.2', 0.9987369179725647)], [[[637.0, 430.0], [673.0, 436.0], [670.0, 460.0], [633.0, 454.0]], ('12.4', 0.9981961846351624)], [[[232.0, 446.0], [267.0, 452.0], [263.0, 475.0], [228.0, 469.0]], ('12.2', 0.9978774189949036)], [[[366.0, 449.0], [402.0, 454.0], [399.0, 478.0], [363.0, 473.0]], ('12.6', 0.9988245368003845)], [[[130.0, 488.0], [162.0, 488.0], [162.0, 513.0], [130.0, 513.0]], ('11.9', 0.8871479034423828)], [[[692.0, 496.0], [728.0, 501.0], [725.0, 524.0], [689.0, 519.0]], ('12.8', 0.9953797459602356)], [[[298.0, 509.0], [331.0, 509.0], [331.0, 535.0], [298.0, 535.0]], ('12.1', 0.9965022206306458)], [[[569.0, 515.0], [606.0, 520.0], [603.0, 544.0], [566.0, 539.0]], ('12.4', 0.9974331855773926)], [[[822.0, 513.0], [856.0, 519.0], [852.0, 540.0], [819.0, 534.0]], ('12.8', 0.8751859664916992)], [[[449.0, 525.0], [474.0, 525.0], [474.0, 547.0], [449.0, 547.0]], ('12', 0.9995641112327576)]])
 
 class Canvas(QWidget):
+    # Выделенная мышью область в координатах изображения
+    regionSelected = pyqtSignal(QRectF)
+    # Номер рамки, по которой щёлкнули
+    boxClicked = pyqtSignal(int)
+    # Область, выделенная с Shift, для сводки по отметкам
+    regionQueried = pyqtSignal(QRectF)
+
     def __init__(self, *args, **kwargs):
         super(Canvas, self).__init__(*args, **kwargs)
         self.pixmap = QPixmap()
@@ -22,110 +56,374 @@ class Canvas(QWidget):
         self.min_scale = 0.5
         self.max_scale = 6.0
         self._painter = QPainter()
+        self.selection = None
+        self._selection_start = None
+        # Рамки рисуются поверх изображения при каждой отрисовке, пиксели изображения не меняются
+        self.results = None
+        self.boxIndex = None
+        self.show_boxes = True
+        self.highlighted = -1
+        # Большие изображения показываются фрагментами пирамиды уровней
+        self.pyramid = None
+        self.preview = QPixmap()
+        self.tiles = OrderedDict()
+        self.tileLoader = TileLoader()
+        self.tileLoader.tileReady.connect(self.handleTile)
+        self.tileLoader.start()
+        # Прокрутки колеса за время таймера применяются одним изменением масштаба
+        self._wheel_steps = 0.0
+        self._zoomTimer = QTimer(self)
+        self._zoomTimer.setSingleShot(True)
+        self._zoomTimer.setInterval(16)
+        self._zoomTimer.timeout.connect(self.applyZoom)
+
+    def imageSize(self):
+        if self.pyramid is not None:
+            return QSize(self.pyramid.width, self.pyramid.height)
+        return self.pixmap.size()
+
+    def hasImage(self):
+        return self.pyramid is not None or not self.pixmap.isNull()
+
+    def setResults(self, results, index=None):
+        self.results = results
+        if results is None or len(results) == 0:
+            index = None
+        elif index is None:
+            index = BoxIndex.from_results(results)
+        self.boxIndex = index
+        self.highlighted = -1
+        self.update()
+
+    def setHighlighted(self, index):
+        if index != self.highlighted:
+            self.highlighted = index
+            self.update()
+
+    def toggleBoxes(self):
+        self.show_boxes = not self.show_boxes
+        self.update()
+
+    def paintBoxes(self, p, rect):
+        # Только рамки, попадающие в перерисовываемую часть холста
+        visible = self.boxIndex.query_rect(rect.left() / self.scale, rect.top() / self.scale,
+                                           (rect.right() + 1) / self.scale, (rect.bottom() + 1) / self.scale)
+        bboxes = self.boxIndex.bboxes
+        p.setPen(QPen(QColor(255, 0, 0), 2))
+        p.drawRects([QRectF(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in bboxes[visible].tolist()])
+        if self.highlighted in visible:
+            x0, y0, x1, y1 = bboxes[self.highlighted].tolist()
+            p.setPen(QPen(QColor(0, 200, 0), 3))
+            p.drawRect(QRectF(x0, y0, x1 - x0, y1 - y0))
+
+    def paintTiles(self, p, rect):
+        # Видимые фрагменты ближайшего к масштабу уровня; недостающие заказываются
+        # в фоне, а пока закрываются обзорным уровнем
+        pyramid = self.pyramid
+        k = pyramid.level_for(self.scale)
+        preview_factor = self.preview.width() / pyramid.width
+        if k == pyramid.preview_level:
+            p.drawPixmap(QRectF(0, 0, pyramid.width, pyramid.height), self.preview, QRectF(self.preview.rect()))
+            return
+        missing = []
+        for key in pyramid.tiles_in(k, rect.left() / self.scale, rect.top() / self.scale,
+                                    (rect.right() + 1) / self.scale, (rect.bottom() + 1) / self.scale):
+            target, source = pyramid.tile_rects(*key)
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                p.drawPixmap(target, tile, QRectF(tile.rect()))
+            else:
+                missing.append(key)
+                p.drawPixmap(target, self.preview, QRectF(target.x() * preview_factor, target.y() * preview_factor,
+                                                          target.width() * preview_factor, target.height() * preview_factor))
+        if missing:
+            self.tileLoader.request(pyramid, missing)
+
+    def handleTile(self, key, qimage):
+        if self.pyramid is None or key[0] != id(self.pyramid):
+            return
+        key = key[1:]
+        self.tiles[key] = QPixmap.fromImage(qimage)
+        while len(self.tiles) > TILE_CACHE:
+            self.tiles.popitem(last=False)
+        target, _ = self.pyramid.tile_rects(*key)
+        self.update(QRectF(target.x() * self.scale, target.y() * self.scale, target.width() * self.scale,
+                           target.height() * self.scale).toAlignedRect().adjusted(-1, -1, 1, 1))
     
     def paintEvent(self, event):
-        if not self.pixmap:
+        if not self.hasImage():
             return super(Canvas, self).paintEvent(event)
         p = self._painter
         p.begin(self)
         p.setRenderHint(QPainter.RenderHint.Antialiasing)
         p.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
         p.scale(self.scale, self.scale)
-        p.drawPixmap(0, 0, self.pixmap)
+        if self.pyramid is not None:
+            self.paintTiles(p, event.rect())
+        else:
+            p.drawPixmap(0, 0, self.pixmap)
+        if self.show_boxes and self.boxIndex is not None:
+            self.paintBoxes(p, event.rect())
+        if self.selection is not None:
+            pen = QPen(QColor(0, 120, 255), 0, Qt.PenStyle.DashLine)
+            p.setPen(pen)
+            p.drawRect(self.selection)
         p.end()
+
+    def to_image(self, pos):
+        size = self.imageSize()
+        x = max(0.0, min(pos.x() / self.scale, size.width()))
+        y = max(0.0, min(pos.y() / self.scale, size.height()))
+        return x, y
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.MouseButton.LeftButton and self.hasImage():
+            self._selection_start = self.to_image(event.position())
+            self.selection = None
+        else:
+            super(Canvas, self).mousePressEvent(event)
+
+    def mouseMoveEvent(self, event):
+        if self._selection_start is not None:
+            (x0, y0), (x1, y1) = self._selection_start, self.to_image(event.position())
+            self.selection = QRectF(min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0))
+            self.update()
+        else:
+            super(Canvas, self).mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        if self._selection_start is not None and event.button() == Qt.MouseButton.LeftButton:
+            self._selection_start = None
+            selection, self.selection = self.selection, None
+            self.update()
+            if selection is not None and selection.width() * self.scale > 4 and selection.height() * self.scale > 4:
+                # С Shift область не распознаётся заново, а показывает сводку по отметкам в ней
+                if event.modifiers() & Qt.KeyboardModifier.ShiftModifier:
+                    self.regionQueried.emit(selection)
+                else:
+                    self.regionSelected.emit(selection)
+            elif self.boxIndex is not None:
+                x, y = self.to_image(event.position())
+                index = self.boxIndex.hit(x, y)
+                if index < 0:
+                    # Щелчок рядом с рамкой выбирает ближайшую рамку
+                    index = self.boxIndex.nearest_box(x, y, HIT_RADIUS / self.scale)
+                self.setHighlighted(index)
+                if index >= 0:
+                    self.boxClicked.emit(index)
+        else:
+            super(Canvas, self).mouseReleaseEvent(event)
         
     def loadPixmap(self, pixmap):
+        self.pyramid = None
+        self.preview = QPixmap()
+        self.tiles.clear()
         self.pixmap = pixmap
         self.scale = 1.0
         self.resizeImageToFit()
         self.repaint()
+
+    def loadPyramid(self, pyramid):
+        self.pixmap = QPixmap()
+        self.pyramid = pyramid
+        self.preview = QPixmap.fromImage(pyramid.preview)
+        self.tiles.clear()
+        self.scale = 1.0
+        self.resizeImageToFit()
+        self.update()
+
+    def clear(self):
+        self.pyramid = None
+        self.preview = QPixmap()
+        self.tiles.clear()
+        self.pixmap = QPixmap()
+        self.setResults(None)
     
     def resizeImageToFit(self):
-        if not self.pixmap:
+        if not self.hasImage():
             return
+        self.scale = max(self.minScale(), min(self.fitScale(), self.max_scale))
+        self.setFixedSize(self.imageSize() * self.scale)
+
+    def fitScale(self):
         area = self.parent().size()
-        w, h = self.pixmap.width(), self.pixmap.height()
-        aw, ah = area.width(), area.height()
-        scale_w = aw / w
-        scale_h = ah / h
-        self.scale = min(scale_w, scale_h)
-        self.scale = max(self.min_scale, min(self.scale, self.max_scale))
-        self.setFixedSize(self.pixmap.size() * self.scale)
+        size = self.imageSize()
+        return min(area.width() / size.width(), area.height() / size.height())
+
+    def minScale(self):
+        # Большие карты можно уменьшить до размера окна
+        return min(self.min_scale, self.fitScale()) if self.pyramid is not None else self.min_scale
     
     def wheelEvent(self, event):
         if event.modifiers() == Qt.KeyboardModifier.ControlModifier:
-            if event.angleDelta().y() > 0:
-                self.scale *= 1.1
-            else:
-                self.scale /= 1.1
-            self.scale = max(self.min_scale, min(self.scale, self.max_scale))
-            self.setFixedSize(self.pixmap.size() * self.scale)
-            self.repaint()
+            self._wheel_steps += event.angleDelta().y() / 120
+            if not self._zoomTimer.isActive():
+                self._zoomTimer.start()
+            event.accept()
         else:
             super(Canvas, self).wheelEvent(event)
 
+    def setScale(self, scale):
+        if self.hasImage():
+            self.scale = max(self.minScale(), min(scale, self.max_scale))
+            self.setFixedSize(self.imageSize() * self.scale)
+            self.update()
+
+    def applyZoom(self):
+        steps, self._wheel_steps = self._wheel_steps, 0.0
+        if not steps or not self.hasImage():
+            return
+        self.scale = max(self.minScale(), min(self.scale * 1.1 ** steps, self.max_scale))
+        self.setFixedSize(self.imageSize() * self.scale)
+        self.update()
+
+class PixmapCache:
+    def __init__(self, max_mb=PREFETCH_MB):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.nbytes = 0
+        self._pixmaps = OrderedDict()
+
+    def __contains__(self, image_path):
+        return image_path in self._pixmaps
+
+    def get(self, image_path):
+        pixmap = self._pixmaps.get(image_path)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(image_path)
+        return pixmap
+
+    def put(self, image_path, pixmap):
+        self.discard(image_path)
+        self._pixmaps[image_path] = pixmap
+        self.nbytes += pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        while self.nbytes > self.max_bytes and len(self._pixmaps) > 1:
+            _, old = self._pixmaps.popitem(last=False)
+            self.nbytes -= old.width() * old.height() * old.depth() // 8
+
+    def discard(self, image_path):
+        old = self._pixmaps.pop(image_path, None)
+        if old is not None:
+            self.nbytes -= old.width() * old.height() * old.depth() // 8
+
+    def clear(self):
+        self._pixmaps.clear()
+        self.nbytes = 0
+
+
+class Prefetcher(QThread):
+    # Заранее декодирует и отрисовывает соседние изображения в фоновом потоке
+    rendered = pyqtSignal(str, QImage)
+    # Для больших изображений вместо целого QImage готовится пирамида уровней
+    pyramidReady = pyqtSignal(str, object)
+
+    def __init__(self, mainThread):
+        super(Prefetcher, self).__init__()
+        self.mainThread = mainThread
+        self.pending = []
+        self.handle = 0
+        self.cond = threading.Condition()
+
+    def request(self, imgs_pathsList):
+        # Новый запрос заменяет ещё не выполненный
+        with self.cond:
+            self.pending = list(imgs_pathsList)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.handle = -1
+            self.cond.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and self.handle == 0:
+                    self.cond.wait()
+                if self.handle != 0:
+                    return
+                image_path = self.pending.pop(0)
+            try:
+                if self.mainThread.is_large(image_path):
+                    self.pyramidReady.emit(image_path, TilePyramid(self.mainThread.image_source(image_path)))
+                else:
+                    self.rendered.emit(image_path, to_qimage(self.mainThread.render_cvimg(image_path)))
+            except Exception as e:
+                print("Prefetcher:", e)
+
+
 class Worker(QThread):
     progressBarValue = pyqtSignal(int)
+    imageDone = pyqtSignal(str)
     endsignal = pyqtSignal(int, str)
     handle = 0
 
-    def __init__(self, ocr, imgs_pathsList, mainThread, model):
+    def __init__(self, ocr, imgs_pathsList, mainThread, model, pool=None):
         super(Worker, self).__init__()
         self.ocr = ocr
         self.imgs_pathsList = imgs_pathsList
         self.mainThread = mainThread
         self.model = model
+        self.pool = pool
+        self.pipeline = None
+        self.control = JobControl()
+        self.processed = set()
         self.setStackSize(1024*1024)
 
-    def poly_to_bbox(self, poly):
-        x1 = np.min([p[0] for p in poly])
-        x2 = np.max([p[0] for p in poly])
-        y1 = np.min([p[1] for p in poly])
-        y2 = np.max([p[1] for p in poly])
-        return [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]
-    
+    def cancel(self):
+        self.handle = -1
+        self.control.cancel()
+        self.quit()
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    def remaining(self):
+        # Изображения, до которых не дошло прерванное задание
+        return [path for path in self.imgs_pathsList if path not in self.processed]
+
+    def results(self):
+        try:
+            if self.pool is not None:
+                yield from self.pool.imap(self.imgs_pathsList, self.control)
+            elif USE_PIPELINE:
+                self.pipeline = OcrPipeline(self.ocr, cache=self.mainThread.ocrCache,
+                                            images=self.mainThread.imageCache, control=self.control)
+                yield from self.pipeline.run(self.imgs_pathsList)
+            else:
+                for Imgpath in self.imgs_pathsList:
+                    self.control.checkpoint()
+                    yield Imgpath, ocr_image(self.ocr, Imgpath, cache=self.mainThread.ocrCache,
+                                             images=self.mainThread.imageCache, control=self.control)
+        except JobCancelled:
+            return
+
     def run(self):
         try:
             findex = 0
-            for Imgpath in self.imgs_pathsList:
-                if self.handle == 0:
-                    if self.model == 'ocr':
-                        Ih, Iw, _ = cv2.imdecode(np.fromfile(Imgpath, dtype=np.uint8), 1).shape
-                        if Ih > 32 and Iw > 32:
-                            temp_result_dic = self.ocr.ocr(Imgpath, cls=False, bin=False, inv=False)[0]
-                            result_dic = []
-                            for res in temp_result_dic:
-                                value = res[1][0]
-                                coords = res[0]
-                                if (coords[0][0] != coords[3][0]) or (coords[1][0] != coords[2][0]) or \
-                                (coords[0][1] != coords[1][1]) or (coords[2][1] != coords[3][1]):
-                                    res[0] = self.poly_to_bbox(coords)
-                                
-                                Bw, Bh = int(coords[1][0] - coords[0][0]), int(coords[3][1] - coords[2][1])
-                                if Bw < 20:
-                                    res[0][0][0], res[0][3][0] = max(0, coords[0][0] - 3), max(0, coords[0][0] - 3)
-                                    res[0][1][0], res[0][2][0] = min(coords[1][0] + 3, Iw), min(coords[1][0] + 3, Iw)
-                                if Bh < 20:
-                                    res[0][0][1], res[0][1][1] = max(0, coords[0][1] - 3), max(0, coords[0][1] - 3)
-                                    res[0][2][1], res[0][3][1] = min(coords[2][1] + 3, Ih), min(coords[2][1] + 3, Ih)
-                                
-                                if len([c for c in value if c.isalpha()]) < 2 and any(c.isdigit() for c in value):
-                                    result_dic.append(res)
-                        else:
-                            print('Размер изображения', Imgpath, 'очень мал для распознавания.')
-                            result_dic = None
-
-                    if result_dic is None or len(result_dic) == 0:
-                        print('Не удалось распознать изображение', Imgpath)
-                        # pass
-                    else:
-                        self.mainThread.results_dic[Imgpath] = result_dic
-                    
-                    findex += 1
-                    self.progressBarValue.emit(findex)
+            for Imgpath, result_dic in self.results():
+                if result_dic is None or len(result_dic) == 0:
+                    print('Не удалось распознать изображение', Imgpath)
+                    # pass
                 else:
+                    self.mainThread.results_dic[Imgpath] = result_dic
+                
+                findex += 1
+                self.processed.add(Imgpath)
+                self.imageDone.emit(Imgpath)
+                self.progressBarValue.emit(findex)
+                if self.handle != 0:
                     break
             
+            if self.pool is not None and self.handle != 0:
+                # Незавершённые задачи пула прерываются, пул будет создан заново
+                self.pool.terminate()
+                self.mainThread.ocrPool = None
+            
             if self.handle == 0:
                 self.endsignal.emit(0, "readAll")
                 self.exec()
@@ -134,14 +432,200 @@ class Worker(QThread):
             print("Worker:", e)
             raise
 
+class ModelLoader(QThread):
+    # Загрузка и пробный прогон моделей в фоне, окно в это время уже работает
+    loaded = pyqtSignal(object, float)
+    failed = pyqtSignal(str)
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            ocr = warmup(create_ocr())
+        except Exception as e:
+            print("ModelLoader:", e)
+            self.failed.emit(str(e))
+            return
+        self.loaded.emit(ocr, time.perf_counter() - start)
+
+class RerecWorker(QThread):
+    # Повторное распознавание по рамкам из results_dic, без модели обнаружения
+    progressBarValue = pyqtSignal(int)
+    imageDone = pyqtSignal(str)
+
+    def __init__(self, imgs_pathsList, mainThread, rec_model_dir=REC_MODEL_DIR,
+                 max_text_length=MAX_TEXT_LENGTH, batch_images=REC_BATCH_IMAGES):
+        super(RerecWorker, self).__init__()
+        self.imgs_pathsList = imgs_pathsList
+        self.mainThread = mainThread
+        self.rec_model_dir = rec_model_dir
+        self.max_text_length = max_text_length
+        self.batch_images = max(1, batch_images)
+        self.control = JobControl()
+
+    def cancel(self):
+        self.control.cancel()
+
+    def run(self):
+        try:
+            ocr = self.mainThread.get_rec_ocr(self.rec_model_dir, self.max_text_length)
+            findex = 0
+            for start in range(0, len(self.imgs_pathsList), self.batch_images):
+                self.control.checkpoint()
+                # Изображение могли удалить из списка, пока шло перераспознавание
+                batch = [Imgpath for Imgpath in self.imgs_pathsList[start:start + self.batch_images]
+                         if Imgpath in self.mainThread.results_dic]
+                # Большие BMP и TIFF не декодируются целиком: фрагменты читаются окнами
+                items = [(self.mainThread.image_source(Imgpath), self.mainThread.results_dic[Imgpath])
+                         for Imgpath in batch]
+                for Imgpath, result_dic in zip(batch, rerecognize(ocr, items)):
+                    if len(result_dic) == 0:
+                        self.mainThread.results_dic.pop(Imgpath, None)
+                    else:
+                        self.mainThread.results_dic[Imgpath] = result_dic
+                    findex += 1
+                    self.imageDone.emit(Imgpath)
+                    self.progressBarValue.emit(findex)
+        except JobCancelled:
+            return
+        except Exception as e:
+            print("RerecWorker:", e)
+            raise
+
+class RegionWorker(QThread):
+    # Распознавание выделенной области; большая область не останавливает окно
+    def __init__(self, ocr, image_path, rect, mainThread):
+        super(RegionWorker, self).__init__()
+        self.ocr = ocr
+        self.image_path = image_path
+        self.rect = (rect.left(), rect.top(), rect.right(), rect.bottom())
+        self.mainThread = mainThread
+        self.region_results = None
+        self.error = None
+
+    def run(self):
+        try:
+            source = self.mainThread.image_source(self.image_path)
+            self.region_results = ocr_region(self.ocr, source, *self.rect, ROI_UPSCALE)
+        except Exception as e:
+            print("RegionWorker:", e)
+            self.error = e
+
+class ExportWorker(QThread):
+    # Сохранение изображений с рамками в процессах ImageExport
+    progressBarValue = pyqtSignal(int)
+
+    def __init__(self, imgs_pathsList, results_dic, directory, ext, quality, labels):
+        super(ExportWorker, self).__init__()
+        self.imgs_pathsList = imgs_pathsList
+        self.results_dic = results_dic
+        self.directory = directory
+        self.ext = ext
+        self.quality = quality
+        self.labels = labels
+        self.control = JobControl()
+        self.saved = 0
+        self.failed = 0
+
+    def cancel(self):
+        self.control.cancel()
+
+    def run(self):
+        try:
+            findex = 0
+            for _, out_path in export_images(self.imgs_pathsList, self.results_dic, self.directory, self.ext,
+                                             self.quality, labels=self.labels, control=self.control):
+                findex += 1
+                if out_path is None:
+                    self.failed += 1
+                else:
+                    self.saved += 1
+                self.progressBarValue.emit(findex)
+        except Exception as e:
+            print("ExportWorker:", e)
+
+class ExportDialog(QDialog):
+    def __init__(self, parent=None, directory=""):
+        super(ExportDialog, self).__init__(parent)
+        self.setWindowTitle("Сохранение изображений")
+        self.scope = QComboBox()
+        self.scope.addItems(["Текущее изображение", "Все изображения"])
+        self.scope.setCurrentIndex(1)
+        self.directory = QLineEdit(directory)
+        btn_browse = QPushButton("Обзор...")
+        btn_browse.clicked.connect(self.browse)
+        directory_layout = QHBoxLayout()
+        directory_layout.addWidget(self.directory)
+        directory_layout.addWidget(btn_browse)
+        self.format = QComboBox()
+        self.format.addItems([ext[1:].upper() for ext in IMAGE_FORMATS])
+        self.quality = QSpinBox()
+        self.quality.setRange(1, 101)
+        self.quality.setValue(EXPORT_QUALITY)
+        self.quality.setToolTip("Для JPEG и WebP; 101 - WebP без потерь")
+        self.labels = QComboBox()
+        self.labels.addItems(["Рамки и текст", "Только рамки"])
+
+        layout = QFormLayout()
+        layout.addRow("Изображения:", self.scope)
+        layout.addRow("Папка:", directory_layout)
+        layout.addRow("Формат:", self.format)
+        layout.addRow("Качество:", self.quality)
+        layout.addRow("Подписи:", self.labels)
+        buttonBox = BB(BB.StandardButton.Ok | BB.StandardButton.Cancel, Qt.Orientation.Horizontal, self)
+        buttonBox.button(BB.StandardButton.Cancel).setText("Отмена")
+        buttonBox.accepted.connect(self.accept)
+        buttonBox.rejected.connect(self.reject)
+        layout.addRow(buttonBox)
+        self.setLayout(layout)
+
+    def browse(self):
+        selected_directory = QFileDialog.getExistingDirectory(self, "Выберите папку для сохранения результатов",
+                                                              self.directory.text())
+        if selected_directory:
+            self.directory.setText(selected_directory)
+
+class RerecDialog(QDialog):
+    def __init__(self, parent=None, rec_model_dir=REC_MODEL_DIR, max_text_length=MAX_TEXT_LENGTH):
+        super(RerecDialog, self).__init__(parent)
+        self.setWindowTitle("Перераспознавание")
+        self.scope = QComboBox()
+        self.scope.addItems(["Текущее изображение", "Все изображения"])
+        self.rec_model_dir = QLineEdit(rec_model_dir)
+        btn_browse = QPushButton("Обзор...")
+        btn_browse.clicked.connect(self.browse)
+        model_layout = QHBoxLayout()
+        model_layout.addWidget(self.rec_model_dir)
+        model_layout.addWidget(btn_browse)
+        self.max_text_length = QSpinBox()
+        self.max_text_length.setRange(1, 100)
+        self.max_text_length.setValue(max_text_length)
+
+        layout = QFormLayout()
+        layout.addRow("Изображения:", self.scope)
+        layout.addRow("Модель распознавания:", model_layout)
+        layout.addRow("Максимальная длина текста:", self.max_text_length)
+        buttonBox = BB(BB.StandardButton.Ok | BB.StandardButton.Cancel, Qt.Orientation.Horizontal, self)
+        buttonBox.button(BB.StandardButton.Cancel).setText("Отмена")
+        buttonBox.accepted.connect(self.accept)
+        buttonBox.rejected.connect(self.reject)
+        layout.addRow(buttonBox)
+        self.setLayout(layout)
+
+    def browse(self):
+        selected_directory = QFileDialog.getExistingDirectory(self, "Выберите папку модели распознавания",
+                                                              self.rec_model_dir.text())
+        if selected_directory:
+            self.rec_model_dir.setText(selected_directory)
+
 class OcrProgressDialog(QDialog):
-    def __init__(self, parent=None, ocr=None, imgs_pathsList=None, lenbar=0):
+    def __init__(self, parent=None, ocr=None, imgs_pathsList=None, lenbar=0, pool=None):
         super(OcrProgressDialog, self).__init__(parent)
         self.setFixedWidth(500)
         self.setWindowTitle("Процесс распознавания..")
         self.OPDparent = parent
         self.ocr = ocr
         self.imgs_pathsList = imgs_pathsList
+        self.pool = pool
         self.lender = lenbar
         self.pb = QProgressBar()
         self.pb.setRange(0, self.lender)
@@ -177,7 +661,7 @@ QPushButton:hover {\n
         self.setLayout(layout)
         self.setWindowModality(Qt.WindowModality.ApplicationModal)
 
-        self.thread_1 = Worker(self.ocr, self.imgs_pathsList, self.OPDparent, 'ocr')
+        self.thread_1 = Worker(self.ocr, self.imgs_pathsList, self.OPDparent, 'ocr', self.pool)
         self.thread_1.progressBarValue.connect(self.handleProgressBarSingal)
         self.thread_1.endsignal.connect(self.handleEndsignalSignal)
 
@@ -196,8 +680,9 @@ QPushButton:hover {\n
 
     def closeEvent(self, event):
         print("closed")
-        self.thread_1.handle = -1
-        self.thread_1.quit()
+        # Ожидание завершения текущего изображения, уже полученные результаты сохраняются
+        self.thread_1.cancel()
+        self.thread_1.wait()
 
         
 
@@ -214,64 +699,588 @@ class MainWindow(QMainWindow, Index.Ui_MainWindow):
         self.btn_open.clicked.connect(self.btn_open_images)
         self.btn_saveData.clicked.connect(self.saveData_clicked)
         self.btn_saveImg.clicked.connect(self.saveImg_clicked)
+        self.btn_rerec.clicked.connect(self.rerec_clicked)
         
         self.imgs_pathsList = []
-        self.current_index = self.stackedWid_images.currentIndex()
+        self.current_index = -1
+        self.canvas = None
         
-        self.ocr = PaddleOCR(show_log=True, use_angle_cls=False, lang="en",
-                                    det_model_dir="models/det/en_PP-OCRv3_det_infer",
-                                    rec_model_dir="models/rec/en_PP-OCRv4_rec_infer",
-                                    cls_model_dir="models/cls",
-                                    use_pdserving=False,
-                                    max_text_length = 5
-        )
+        # Модели загружаются в фоне; до этого изображения ждут в waiting_pathsList
+        self.ocr = None
+        self.waiting_pathsList = []
+        self.first_paint = None
+        self.modelStatus = QLabel("Модель загружается...")
+        self.statusBar().addPermanentWidget(self.modelStatus)
+        self.modelLoader = ModelLoader()
+        self.modelLoader.loaded.connect(self.handleModelLoaded)
+        self.modelLoader.failed.connect(self.handleModelFailed)
+        self.modelLoader.start()
+        
+        # 0 - процессов по числу ядер
+        self.ocr_processes = DEFAULT_PROCESSES or os.cpu_count() or 1
+        self.ocr_threads = DEFAULT_THREADS
+        self.ocrPool = None
+        self.ocrCache = OcrCache() if CACHE_MAX_MB > 0 else None
+        self.imageCache = ImageCache()
+        self.pixmapCache = PixmapCache()
+        self.pyramidCache = OrderedDict()
+        self.imageSizes = {}
+        self.prefetch_window = PREFETCH_WINDOW
+        self.prefetcher = Prefetcher(self)
+        self.prefetcher.rendered.connect(self.handlePrefetched)
+        self.prefetcher.pyramidReady.connect(self.handlePrefetchedPyramid)
+        self.prefetcher.start()
         
         self.results_dic = {}
+        # Пространственные индексы результатов: путь -> (результаты, BoxIndex)
+        self.spatialIndexes = {}
         self.ocrProgressDialog = None
+        self.ProgressDialogRes = None
+        
+        self.stream_results = STREAM_RESULTS
+        self.ocrWorker = None
+        self.statusProgress = QProgressBar()
+        self.statusProgress.setMaximumWidth(300)
+        self.statusProgress.setFormat("Распознавание: %v из %m")
+        self.statusProgress.hide()
+        self.statusBar().addPermanentWidget(self.statusProgress)
+        self.btn_pauseOcr = QPushButton("Пауза")
+        self.btn_pauseOcr.clicked.connect(self.toggle_pause_ocr)
+        self.btn_pauseOcr.hide()
+        self.statusBar().addPermanentWidget(self.btn_pauseOcr)
+        self.btn_cancelOcr = QPushButton("Отмена")
+        self.btn_cancelOcr.clicked.connect(self.cancel_ocr)
+        self.btn_cancelOcr.hide()
+        self.statusBar().addPermanentWidget(self.btn_cancelOcr)
+        self.pending_pathsList = []
+        # Номера изображений в порядке выбора: распознанное изображение встаёт в список
+        # на своё место, а не в порядке готовности
+        self.selection_order = {}
+        self.selection_counter = itertools.count()
+        # Распознаватели с другой моделью или длиной текста для перераспознавания
+        self.rec_model_dir = REC_MODEL_DIR
+        self.max_text_length = MAX_TEXT_LENGTH
+        self.recOcrs = {}
+        self.rerecWorker = None
+        self.regionWorker = None
+        # Сохранение изображений с рамками
+        self.exportWorker = None
+        self.export_directory = ""
+        
+        # Удаление и перестановка текущего изображения
+        QShortcut(QKeySequence(Qt.Key.Key_Delete), self, lambda: self.remove_image(self.current_index))
+        QShortcut(QKeySequence("Ctrl+Left"), self, lambda: self.move_image(self.current_index, self.current_index - 1))
+        QShortcut(QKeySequence("Ctrl+Right"), self, lambda: self.move_image(self.current_index, self.current_index + 1))
+        # Показать или скрыть рамки результатов
+        QShortcut(QKeySequence("Ctrl+B"), self, lambda: self.canvas is not None and self.canvas.toggleBoxes())
+        # Сохранение сеанса: список изображений, результаты и состояние просмотра
+        self.session_path = None
+        # Файл сеанса, в который отображены результаты (открыт или пересохранён)
+        self.mapped_session = None
+        self.changed_paths = set()
+        QShortcut(QKeySequence("Ctrl+S"), self, lambda: self.save_session_clicked(self.session_path))
+        QShortcut(QKeySequence("Ctrl+Shift+S"), self, lambda: self.save_session_clicked(None))
+
+    def get_ocr_pool(self):
+        if self.ocr_processes > 1 and self.ocrPool is None:
+            self.ocrPool = OcrPool(self.ocr_processes, self.ocr_threads, cache=self.ocrCache)
+        return self.ocrPool
+
+    def get_rec_ocr(self, rec_model_dir, max_text_length):
+        # Вызывается из потока перераспознавания: загрузка модели не блокирует окно
+        key = (os.path.abspath(rec_model_dir), max_text_length)
+        if key == (os.path.abspath(REC_MODEL_DIR), MAX_TEXT_LENGTH):
+            return self.ocr
+        if key not in self.recOcrs:
+            self.recOcrs[key] = create_ocr(show_log=False, rec_model_dir=rec_model_dir, max_text_length=max_text_length)
+        return self.recOcrs[key]
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.first_paint is None:
+            self.first_paint = time.perf_counter() - _START_TIME
+            print(f"Окно показано через {self.first_paint:.2f} с после запуска")
+
+    def handleModelLoaded(self, ocr, seconds):
+        self.ocr = ocr
+        self.modelStatus.setText("Модель готова")
+        print(f"Модель загружена за {seconds:.1f} с, готова через {time.perf_counter() - _START_TIME:.1f} с после запуска")
+        if self.waiting_pathsList:
+            waiting_pathsList, self.waiting_pathsList = self.waiting_pathsList, []
+            self.add_images(waiting_pathsList)
+
+    def handleModelFailed(self, message):
+        self.modelStatus.setText("Модель не загружена")
+        QMessageBox.warning(self, "Ошибка", f"Не удалось загрузить модель распознавания:\n{message}")
+
+    def model_ready(self):
+        if self.ocr is None:
+            self.statusBar().showMessage("Модель распознавания ещё загружается", 5000)
+        return self.ocr is not None
+
+    def closeEvent(self, event):
+        self.prefetcher.stop()
+        self.modelLoader.wait()
+        if self.canvas is not None:
+            self.canvas.tileLoader.stop()
+        for worker in (self.ocrWorker, self.rerecWorker, self.exportWorker):
+            if worker is not None and worker.isRunning():
+                worker.cancel()
+                worker.wait()
+        if self.regionWorker is not None:
+            self.regionWorker.wait()
+        if self.ocrPool is not None:
+            self.ocrPool.terminate()
+            self.ocrPool = None
+        super().closeEvent(event)
 
     def btn_open_images(self):
-        clear_flag = False
-        previous_paths = set(self.imgs_pathsList)
-        selected_pathsList = QFileDialog.getOpenFileNames(self, "Выберите изображения", "", "Images (*.png *.jpg *.jpeg *.bmp)")[0]
-        if set(selected_pathsList) - previous_paths:
-            self.imgs_pathsList.extend(selected_pathsList)
-        if self.imgs_pathsList and selected_pathsList and set(selected_pathsList) - previous_paths:
-            if self.stackedWid_images.count() > 0:
-                temp_index = self.stackedWid_images.currentIndex()
-                self.clear_all_pages()
-                clear_flag = True
-            
-            self.results_dic = {}
-            if self.ocrProgressDialog is None or self.ocrProgressDialog.isHidden():
-                self.ocrProgressDialog = OcrProgressDialog(parent=self, ocr=self.ocr, imgs_pathsList=self.imgs_pathsList, lenbar=len(self.imgs_pathsList))
-                self.ProgressDialogRes = self.ocrProgressDialog.popUp()
-                print(self.ProgressDialogRes)
-            
-            if self.ProgressDialogRes:
-                for _ in range(len(self.imgs_pathsList)):
-                    self.createPages()
-                
-                if clear_flag: self.stackedWid_images.setCurrentIndex(temp_index)
-            
-                self.btn_arrowL.setEnabled(True)
-                self.btn_arrowR.setEnabled(True)
-                
-                self.current_index = self.stackedWid_images.currentIndex()
-                image_name = self.imgs_pathsList[self.current_index].split('/')[-1]
-                self.imgName_label.setText(f"№ {self.current_index + 1} | {image_name}")
-                self.updateCurrentCanvas(self.imgs_pathsList[self.current_index])
+        selected_pathsList = QFileDialog.getOpenFileNames(self, "Выберите изображения", "", "Images (*.png *.jpg *.jpeg *.bmp *.tif *.tiff);;Результаты распознавания (*.csv *.jsonl *.parquet *.feather);;Сеанс LocMap (*.locmap)")[0]
+        # Сеанс заменяет открытые изображения, таблицы результатов загружаются без распознавания
+        for path in selected_pathsList:
+            if path.lower().endswith(SESSION_EXTENSION):
+                self.open_session(path)
+            elif path.lower().endswith(EXPORT_FORMATS):
+                self.load_results(path)
+        selected_pathsList = [path for path in selected_pathsList
+                              if not path.lower().endswith(EXPORT_FORMATS + (SESSION_EXTENSION,))]
+        previous_paths = self.known_paths()
+        new_pathsList = [path for path in dict.fromkeys(selected_pathsList) if path not in previous_paths]
+        if new_pathsList:
+            self.add_images(new_pathsList)
+
+    def known_paths(self):
+        # Открытые изображения и те, что ещё распознаются или ждут распознавания
+        paths = set(self.imgs_pathsList) | set(self.waiting_pathsList) | set(self.pending_pathsList)
+        if self.ocrWorker is not None and self.ocrWorker.isRunning():
+            paths.update(self.ocrWorker.imgs_pathsList)
+        return paths
+
+    def view_state(self):
+        view = {"current_image": self.imgs_pathsList[self.current_index] if self.current_index >= 0 else None}
+        if self.canvas is not None:
+            view.update(scale=self.canvas.scale, show_boxes=self.canvas.show_boxes,
+                        scroll=[self.scroll_area.horizontalScrollBar().value(),
+                                self.scroll_area.verticalScrollBar().value()])
+        return view
+
+    def save_session_clicked(self, path=None):
+        if not path:
+            path = QFileDialog.getSaveFileName(self, "Сохранить сеанс", "session.locmap", "Сеанс LocMap (*.locmap)")[0]
+            if not path:
+                return
+            if not path.lower().endswith(SESSION_EXTENSION):
+                path += SESSION_EXTENSION
+        # Отображённый в память файл нельзя заменить (в Windows): перед сохранением
+        # результаты копируются в память, после - отображается уже новый файл
+        remap = self.mapped_session is not None and os.path.exists(path) and os.path.samefile(path, self.mapped_session)
+        if remap:
+            if any(worker is not None and worker.isRunning() for worker in (self.ocrWorker, self.rerecWorker, self.exportWorker)):
+                self.statusBar().showMessage("Дождитесь окончания текущего распознавания или сохранения", 5000)
+                return
+            self.replace_results(copy_results(self.results_dic))
+            self.mapped_session = None
+        try:
+            save_session(path, self.imgs_pathsList, self.results_dic, self.view_state())
+        except Exception as e:
+            print("Ошибка сохранения сеанса", path, e)
+            QMessageBox.warning(self, "Информация", f"Сеанс не сохранён!\n{e}")
+            return
+        if remap:
+            try:
+                results_dic = dict(self.results_dic)
+                results_dic.update(load_session(path)[1])
+                self.replace_results(results_dic)
+                self.mapped_session = path
+            except Exception as e:
+                print("Ошибка чтения сеанса", path, e)
+        self.session_path = path
+        self.changed_paths = set()
+        self.statusBar().showMessage(f"Сеанс сохранён в {path}", 5000)
+
+    def open_session(self, path):
+        if any(worker is not None and worker.isRunning() for worker in (self.ocrWorker, self.rerecWorker, self.regionWorker)):
+            self.statusBar().showMessage("Дождитесь окончания текущего распознавания", 5000)
+            return
+        try:
+            loaded_pathsList, loaded_dic, view, changed = load_session(path)
+        except Exception as e:
+            print("Ошибка чтения сеанса", path, e)
+            QMessageBox.warning(self, "Информация", f"Не удалось открыть сеанс\n{path}")
+            return
+        # Пропавшие изображения не открываются, изменённые отмечаются в подписи
+        missing = [img_path for img_path in changed if not os.path.exists(img_path)]
+        if missing:
+            print(f'Не найдено изображений сеанса: {len(missing)}', *missing[:10], sep='\n')
+        self.changed_paths = set(changed) - set(missing)
+        missing = set(missing)
+        self.session_path = path
+        self.mapped_session = path
+        self.imgs_pathsList = [img_path for img_path in loaded_pathsList if img_path not in missing]
+        self.results_dic = {img_path: res for img_path, res in loaded_dic.items() if img_path not in missing}
+        self.spatialIndexes.clear()
+        self.waiting_pathsList = []
+        self.pending_pathsList = []
+        self.selection_order.clear()
+        self.imageCache.clear()
+        self.pixmapCache.clear()
+        self.pyramidCache.clear()
+        self.statusBar().showMessage(f"Открыт сеанс: изображений {len(self.imgs_pathsList)}, "
+                                     f"изменено {len(self.changed_paths)}, не найдено {len(missing)}")
+        if not self.imgs_pathsList:
+            self.current_index = -1
+            if self.canvas is not None:
+                self.canvas.clear()
+            return
+        self.ProgressDialogRes = 1
+        if self.canvas is None:
+            self.createPages()
+        self.btn_arrowL.setEnabled(True)
+        self.btn_arrowR.setEnabled(True)
+        self.current_index = -1
+        current_image = view.get("current_image")
+        self.showPage(self.imgs_pathsList.index(current_image) if current_image in self.imgs_pathsList else 0)
+        if "scale" in view:
+            self.canvas.show_boxes = view.get("show_boxes", True)
+            self.canvas.setScale(view["scale"])
+            # Полосы прокрутки получают новый диапазон после компоновки
+            scroll = view.get("scroll", [0, 0])
+            QTimer.singleShot(0, lambda: (self.scroll_area.horizontalScrollBar().setValue(scroll[0]),
+                                          self.scroll_area.verticalScrollBar().setValue(scroll[1])))
+
+    def replace_results(self, results_dic):
+        # Те же результаты в других массивах: индексы и холст переходят на новые
+        self.results_dic = results_dic
+        self.spatialIndexes.clear()
+        if 0 <= self.current_index < len(self.imgs_pathsList):
+            self.refresh_results(self.imgs_pathsList[self.current_index])
+
+    def load_results(self, path):
+        try:
+            loaded_pathsList, loaded_dic = read_results(path)
+        except Exception as e:
+            print("Ошибка чтения результатов", path, e)
+            QMessageBox.warning(self, "Информация", f"Не удалось прочитать результаты\n{path}")
+            return
+        # Результаты уже открытых изображений заменяются загруженными;
+        # изображения, которые не были распознаны, отправляются на распознавание
+        previous_paths = self.known_paths()
+        existing_pathsList = [img_path for img_path in loaded_pathsList if os.path.exists(img_path)]
+        if len(existing_pathsList) < len(loaded_pathsList):
+            print('Не найдено изображений из', path, ':', len(loaded_pathsList) - len(existing_pathsList))
+        found_pathsList = [img_path for img_path in existing_pathsList if img_path in loaded_dic]
+        unprocessed_pathsList = [img_path for img_path in existing_pathsList
+                                 if img_path not in loaded_dic and img_path not in previous_paths]
+        for img_path in found_pathsList:
+            # В окне изображение без найденного текста просто не имеет результатов
+            if len(loaded_dic[img_path]):
+                self.results_dic[img_path] = loaded_dic[img_path]
+            else:
+                self.results_dic.pop(img_path, None)
+        self.statusBar().showMessage(f"Загружены результаты изображений: {len(found_pathsList)} из {len(loaded_pathsList)}", 5000)
+        if unprocessed_pathsList:
+            self.add_images(unprocessed_pathsList)
+        if not found_pathsList:
+            return
+        self.ProgressDialogRes = 1
+        self.imgs_pathsList.extend(img_path for img_path in found_pathsList if img_path not in previous_paths)
+        if self.canvas is None:
+            self.createPages()
+        self.btn_arrowL.setEnabled(True)
+        self.btn_arrowR.setEnabled(True)
+        self.showPage(max(self.current_index, 0))
+
+    def add_images(self, new_pathsList):
+        # Распознаются только новые изображения, прежние результаты и страницы сохраняются
+        if self.ocr is None and self.ocr_processes <= 1:
+            # Пулу процессов модель главного окна не нужна
+            self.waiting_pathsList.extend(new_pathsList)
+            self.statusBar().showMessage("Распознавание начнётся после загрузки модели")
+            return
+        if self.stream_results:
+            return self.stream_images(new_pathsList)
+        if self.ocrProgressDialog is not None and not self.ocrProgressDialog.isHidden():
+            return
+        self.ocrProgressDialog = OcrProgressDialog(parent=self, ocr=self.ocr, imgs_pathsList=new_pathsList, lenbar=len(new_pathsList), pool=self.get_ocr_pool())
+        res = self.ocrProgressDialog.popUp()
+        print(res)
+        if not res:
+            # Распознавание прервано: добавляются уже обработанные изображения
+            processed = self.ocrProgressDialog.thread_1.processed
+            new_pathsList = [path for path in new_pathsList if path in processed]
+            if not new_pathsList:
+                return
+        self.ProgressDialogRes = 1
         
-    def clear_all_pages(self):
-        while self.stackedWid_images.count() > 0:
-            page = self.stackedWid_images.widget(0)
-            self.stackedWid_images.removeWidget(page)
-            page.deleteLater()
-            
+        self.imgs_pathsList.extend(new_pathsList)
+        if self.canvas is None:
+            self.createPages()
+        
+        self.btn_arrowL.setEnabled(True)
+        self.btn_arrowR.setEnabled(True)
+        self.showPage(max(self.current_index, 0))
+
+    def stream_images(self, new_pathsList):
+        # Каждое изображение появляется в просмотре сразу после распознавания
+        for path in new_pathsList:
+            if path not in self.selection_order:
+                self.selection_order[path] = next(self.selection_counter)
+        # Полоса прогресса и кнопка отмены общие, поэтому задания идут по одному
+        if any(worker is not None and worker.isRunning()
+               for worker in (self.ocrWorker, self.rerecWorker, self.regionWorker, self.exportWorker)):
+            # Выбранные во время распознавания изображения распознаются следующим заданием
+            self.waiting_pathsList.extend(new_pathsList)
+            self.statusBar().showMessage(f"Изображений в очереди: {len(self.waiting_pathsList)}", 5000)
+            return
+        self.ProgressDialogRes = 1
+        self.ocrWorker = Worker(self.ocr, new_pathsList, self, 'ocr', self.get_ocr_pool())
+        self.ocrWorker.imageDone.connect(self.handleImageDone)
+        self.ocrWorker.progressBarValue.connect(self.statusProgress.setValue)
+        self.ocrWorker.endsignal.connect(self.handleStreamEnd)
+        self.ocrWorker.finished.connect(self.handleStreamFinished)
+        self.statusProgress.setRange(0, len(new_pathsList))
+        self.statusProgress.setValue(0)
+        self.statusProgress.show()
+        self.btn_pauseOcr.setText("Пауза")
+        self.btn_pauseOcr.show()
+        self.btn_cancelOcr.show()
+        self.ocrWorker.start()
+
+    def handleImageDone(self, image_path):
+        # Перед изображением встают только выбранные позже него
+        rank = self.selection_order.get(image_path, -1)
+        index = len(self.imgs_pathsList)
+        while index > 0 and self.selection_order.get(self.imgs_pathsList[index - 1], -1) > rank:
+            index -= 1
+        self.imgs_pathsList.insert(index, image_path)
+        if index <= self.current_index:
+            self.current_index += 1
+            self.update_image_label()
+        if self.ocrWorker.pipeline is not None:
+            # Заполненность очередей показывает, какая стадия сдерживает конвейер
+            depths = ", ".join(f"{stage}: {n}" for stage, n in self.ocrWorker.pipeline.depths().items())
+            self.statusProgress.setToolTip(f"Очереди стадий: {depths}")
+        if self.canvas is None:
+            self.createPages()
+            self.btn_arrowL.setEnabled(True)
+            self.btn_arrowR.setEnabled(True)
+        if self.current_index < 0:
+            self.showPage(0)
+
+    def handleStreamEnd(self, i, str):
+        self.ocrWorker.quit()
+        self.statusBar().showMessage(f"Распознавание завершено, изображений: {len(self.imgs_pathsList)}", 5000)
+
+    def handleStreamFinished(self):
+        self.statusProgress.hide()
+        self.ocrWorker.wait()
+        self.pending_pathsList = self.ocrWorker.remaining()
+        if self.pending_pathsList:
+            # Прерванное задание можно продолжить с того же места вместе с очередью
+            self.pending_pathsList += self.waiting_pathsList
+            self.waiting_pathsList = []
+            self.statusBar().showMessage(f"Распознавание прервано, осталось изображений: {len(self.pending_pathsList)}")
+            self.btn_pauseOcr.setText("Продолжить")
+        else:
+            self.btn_pauseOcr.hide()
+            self.btn_cancelOcr.hide()
+            self.start_waiting()
+
+    def start_waiting(self):
+        if self.waiting_pathsList and not self.pending_pathsList:
+            waiting_pathsList, self.waiting_pathsList = self.waiting_pathsList, []
+            self.add_images(waiting_pathsList)
+
+    def toggle_pause_ocr(self):
+        worker = self.ocrWorker
+        if worker is not None and worker.isRunning():
+            if worker.control.paused:
+                worker.resume()
+                self.btn_pauseOcr.setText("Пауза")
+                self.statusBar().clearMessage()
+            else:
+                worker.pause()
+                self.btn_pauseOcr.setText("Продолжить")
+                self.statusBar().showMessage("Распознавание приостановлено")
+        elif self.pending_pathsList:
+            pending_pathsList, self.pending_pathsList = self.pending_pathsList, []
+            self.stream_images(pending_pathsList)
+
+    def cancel_ocr(self):
+        if self.exportWorker is not None and self.exportWorker.isRunning():
+            self.exportWorker.cancel()
+        elif self.ocrWorker is not None and self.ocrWorker.isRunning():
+            self.ocrWorker.cancel()
+        else:
+            self.pending_pathsList = []
+            self.btn_pauseOcr.hide()
+            self.btn_cancelOcr.hide()
+            self.statusBar().clearMessage()
+
+    def rerec_clicked(self):
+        if not self.model_ready():
+            return
+        if any(worker is not None and worker.isRunning()
+               for worker in (self.ocrWorker, self.rerecWorker, self.regionWorker, self.exportWorker)):
+            self.statusBar().showMessage("Дождитесь окончания текущего распознавания или сохранения", 5000)
+            return
+        dialog = RerecDialog(self, self.rec_model_dir, self.max_text_length)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        self.rec_model_dir = dialog.rec_model_dir.text()
+        self.max_text_length = dialog.max_text_length.value()
+        if dialog.scope.currentIndex() == 0:
+            rerec_pathsList = [self.imgs_pathsList[self.current_index]] if self.current_index >= 0 else []
+        else:
+            rerec_pathsList = list(self.imgs_pathsList)
+        # Изображения без рамок перераспознавать нечем
+        rerec_pathsList = [path for path in rerec_pathsList if path in self.results_dic]
+        if not rerec_pathsList:
+            self.statusBar().showMessage("Нет результатов для перераспознавания", 5000)
+            return
+        self.rerecWorker = RerecWorker(rerec_pathsList, self, self.rec_model_dir, self.max_text_length)
+        self.rerecWorker.imageDone.connect(self.handleRerecDone)
+        self.rerecWorker.progressBarValue.connect(self.statusProgress.setValue)
+        self.rerecWorker.finished.connect(self.handleRerecFinished)
+        self.statusProgress.setFormat("Перераспознавание: %v из %m")
+        self.statusProgress.setRange(0, len(rerec_pathsList))
+        self.statusProgress.setValue(0)
+        self.statusProgress.show()
+        self.btn_rerec.setEnabled(False)
+        self.rerecWorker.start()
+
+    def index_for(self, image_path):
+        # Пространственный индекс результатов изображения; строится заново,
+        # только когда результаты изображения заменены
+        ocr_results = self.results_for(image_path)
+        if ocr_results is None:
+            self.spatialIndexes.pop(image_path, None)
+            return None
+        cached = self.spatialIndexes.get(image_path)
+        if cached is None or cached[0] is not ocr_results:
+            cached = (ocr_results, BoxIndex.from_results(ocr_results))
+            self.spatialIndexes[image_path] = cached
+        return cached[1]
+
+    def summarize_region(self, rect):
+        # Число отметок с центром в области и их наименьшая, наибольшая и средняя глубины
+        if self.current_index < 0:
+            return
+        image_path = self.imgs_pathsList[self.current_index]
+        index = self.index_for(image_path)
+        found = index.within_rect(rect.left(), rect.top(), rect.right(), rect.bottom()) if index is not None else []
+        if len(found) == 0:
+            self.statusBar().showMessage("В выделенной области нет отметок", 5000)
+            return
+        texts = self.ocr_results.texts
+        depths = []
+        for i in found.tolist():
+            try:
+                depths.append(float(texts[i].replace(',', '.')))
+            except ValueError:
+                pass
+        message = f"Отметок в области: {len(found)}"
+        if depths:
+            message += f", глубины: {min(depths):g} - {max(depths):g}, средняя {sum(depths) / len(depths):.2f}"
+        self.statusBar().showMessage(message, 10000)
+
+    def ocr_selected_region(self, rect):
+        # Распознавание только выделенной области; прежние результаты внутри неё заменяются
+        if self.current_index < 0 or not self.model_ready():
+            return
+        if any(worker is not None and worker.isRunning() for worker in (self.ocrWorker, self.rerecWorker, self.regionWorker)):
+            self.statusBar().showMessage("Дождитесь окончания текущего распознавания", 5000)
+            return
+        self.regionWorker = RegionWorker(self.ocr, self.imgs_pathsList[self.current_index], rect, self)
+        self.regionWorker.finished.connect(self.handleRegionFinished)
+        self.statusBar().showMessage("Распознавание выделенной области...")
+        self.regionWorker.start()
+
+    def handleRegionFinished(self):
+        worker = self.regionWorker
+        worker.wait()
+        image_path, region_results = worker.image_path, worker.region_results
+        x0, y0, x1, y1 = worker.rect
+        # Изображения, выбранные во время распознавания области, - после обновления результатов
+        QTimer.singleShot(0, self.start_waiting)
+        if worker.error is not None:
+            self.statusBar().showMessage(f"Ошибка распознавания области: {worker.error}", 5000)
+            return
+        # Изображение могли удалить из списка, пока шло распознавание
+        if image_path not in self.imgs_pathsList:
+            self.statusBar().clearMessage()
+            return
+        if region_results is None:
+            self.statusBar().showMessage("Выделенная область слишком мала для распознавания", 5000)
+            return
+        result_dic = replace_region(self.results_dic.get(image_path), region_results, x0, y0, x1, y1)
+        if len(result_dic) == 0:
+            self.results_dic.pop(image_path, None)
+        else:
+            self.results_dic[image_path] = result_dic
+        self.ProgressDialogRes = 1
+        self.refresh_results(image_path)
+        self.statusBar().showMessage(f"В выделенной области распознано: {len(region_results)}", 5000)
+
+    def handleRerecDone(self, image_path):
+        self.refresh_results(image_path)
+
+    def refresh_results(self, image_path):
+        # После изменения результатов обновляются списки и рамки на холсте;
+        # изображение и масштаб остаются прежними
+        if 0 <= self.current_index < len(self.imgs_pathsList) and self.imgs_pathsList[self.current_index] == image_path:
+            self.perform_ocr(image_path)
+            self.canvas.setResults(self.ocr_results, self.index_for(image_path))
+
+    def handleRerecFinished(self):
+        self.statusProgress.hide()
+        self.statusProgress.setFormat("Распознавание: %v из %m")
+        self.btn_rerec.setEnabled(True)
+        self.statusBar().showMessage("Перераспознавание завершено", 5000)
+        self.rerecWorker.wait()
+        if not (self.ocrWorker is not None and self.ocrWorker.isRunning()):
+            self.start_waiting()
+
+    def remove_image(self, index):
+        if not 0 <= index < len(self.imgs_pathsList):
+            return
+        image_path = self.imgs_pathsList.pop(index)
+        self.results_dic.pop(image_path, None)
+        self.selection_order.pop(image_path, None)
+        self.spatialIndexes.pop(image_path, None)
+        self.imageCache.discard(image_path)
+        self.pixmapCache.discard(image_path)
+        self.pyramidCache.pop(image_path, None)
+        if self.imgs_pathsList:
+            self.showPage(min(index, len(self.imgs_pathsList) - 1))
+        else:
+            self.current_index = -1
+            self.imgName_label.setText("")
+            self.listWidget_rec.clear()
+            self.listWidget_coor.clear()
+            self.btn_arrowL.setEnabled(False)
+            self.btn_arrowR.setEnabled(False)
+            self.canvas.clear()
+
+    def move_image(self, index, new_index):
+        if not self.imgs_pathsList:
+            return
+        new_index %= len(self.imgs_pathsList)
+        self.imgs_pathsList.insert(new_index, self.imgs_pathsList.pop(index))
+        self.showPage(new_index)
+
     def createPages(self):
+        # Одна страница с холстом на все изображения: при переходе холст
+        # получает другое изображение, число виджетов не зависит от числа файлов
         self.page = QWidget()
         self.page.setObjectName("page")
         
         self.canvas = Canvas(parent=self)
+        self.canvas.regionSelected.connect(self.ocr_selected_region)
+        self.canvas.regionQueried.connect(self.summarize_region)
+        self.canvas.boxClicked.connect(self.listWidget_rec.setCurrentRow)
+        self.canvas.boxClicked.connect(self.listWidget_coor.setCurrentRow)
+        self.listWidget_rec.currentRowChanged.connect(self.canvas.setHighlighted)
         
         self.scroll_area = QScrollArea(parent=self.page)
         self.scroll_area.setWidgetResizable(True)
@@ -289,89 +1298,192 @@ class MainWindow(QMainWindow, Index.Ui_MainWindow):
         self.listWidget_coor.clear()
         
     def updateCurrentCanvas(self, image_path):
-        current_widget = self.stackedWid_images.currentWidget()
-        if current_widget:
-            canvas = current_widget.findChild(Canvas)
-            if canvas:
-                self.cvimg = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), 1)
-                height, width, depth = self.cvimg.shape
-                if self.ProgressDialogRes:
-                    self.perform_ocr(image_path)
-                self.image = QImage(self.cvimg.data, width, height, width * depth, QImage.Format.Format_BGR888)
-                canvas.loadPixmap(QPixmap.fromImage(self.image))
-                canvas.repaint()
+        canvas = self.canvas
+        if canvas:
+            if self.ProgressDialogRes:
+                self.perform_ocr(image_path)
+            canvas.setResults(self.ocr_results if self.ProgressDialogRes else None,
+                              self.index_for(image_path) if self.ProgressDialogRes else None)
+            if self.is_large(image_path):
+                canvas.loadPyramid(self.get_pyramid(image_path))
+            else:
+                pixmap = self.pixmapCache.get(image_path)
+                if pixmap is None:
+                    pixmap = QPixmap.fromImage(to_qimage(self.render_cvimg(image_path)))
+                    self.pixmapCache.put(image_path, pixmap)
+                canvas.loadPixmap(pixmap)
+            canvas.repaint()
+            self.prefetch_neighbours()
+
+    def is_large(self, image_path):
+        # Изображения больше PYRAMID_MIN_SIDE показываются по фрагментам
+        if image_path not in self.imageSizes:
+            self.imageSizes[image_path] = image_size(image_path)
+        return max(self.imageSizes[image_path]) >= PYRAMID_MIN_SIDE
+
+    def image_source(self, image_path):
+        # Большие несжатые BMP и TIFF читаются окнами из отображённого в память файла,
+        # остальные декодируются целиком через общий кэш
+        source = open_source(image_path) if self.is_large(image_path) else None
+        return source if source is not None else self.imageCache.get(image_path)
+
+    def get_pyramid(self, image_path):
+        pyramid = self.pyramidCache.get(image_path)
+        if pyramid is None:
+            pyramid = TilePyramid(self.image_source(image_path))
+            self.put_pyramid(image_path, pyramid)
+        else:
+            self.pyramidCache.move_to_end(image_path)
+        return pyramid
+
+    def put_pyramid(self, image_path, pyramid):
+        # Пирамиды держатся для текущего и ближайших соседних изображений;
+        # соседей не больше 2 * prefetch_window, поэтому текущая не вытесняется
+        self.pyramidCache[image_path] = pyramid
+        self.pyramidCache.move_to_end(image_path)
+        while len(self.pyramidCache) > 2 * self.prefetch_window + 1:
+            self.pyramidCache.popitem(last=False)
+
+    def results_for(self, image_path):
+        ocr_results = self.results_dic.get(image_path, None)
+        if "172117.png" in image_path and ocr_results is not SAMPLE_RESULTS:
+            # Результаты образца сохраняются один раз, индекс и холст переиспользуют их
+            ocr_results = self.results_dic[image_path] = SAMPLE_RESULTS
+        return ocr_results
+
+    def render_cvimg(self, image_path):
+        # Рамки не рисуются в пикселях, их рисует холст, поэтому готовое
+        # изображение не зависит от результатов распознавания
+        return self.imageCache.get(image_path)
+
+    def prefetch_neighbours(self):
+        # Соседние изображения в порядке удалённости от текущего: +1, -1, +2, -2, ...
+        count = len(self.imgs_pathsList)
+        neighbours = []
+        for step in range(1, self.prefetch_window + 1):
+            for index in (self.current_index + step, self.current_index - step):
+                image_path = self.imgs_pathsList[index % count]
+                if image_path not in neighbours and image_path not in self.pixmapCache \
+                        and image_path not in self.pyramidCache:
+                    neighbours.append(image_path)
+        self.prefetcher.request(neighbours)
+
+    def handlePrefetched(self, image_path, qimage):
+        if image_path in self.imgs_pathsList:
+            self.pixmapCache.put(image_path, QPixmap.fromImage(qimage))
+
+    def handlePrefetchedPyramid(self, image_path, pyramid):
+        if image_path in self.imgs_pathsList:
+            self.put_pyramid(image_path, pyramid)
     
     def perform_ocr(self, image_path):
         self.listWidget_rec.clear()
         self.listWidget_coor.clear()
-        self.ocr_results = self.results_dic.get(image_path, None)
-        if "172117.png" in image_path:
-            self.ocr_results = [[[[496.0, 1.0], [528.0, 6.0], [525.0, 26.0], [493.0, 22.0]], ('11.8', 0.9021782875061035)], [[[719.0, 0.0], [753.0, 4.0], [749.0, 25.0], [715.0, 17.0]], ('12.4', 0.9965363144874573)], [[[101.0, 26.0], [135.0, 33.0], [131.0, 56.0], [97.0, 50.0]], ('11.6', 0.9851365089416504)], [[[236.0, 30.0], [271.0, 36.0], [268.0, 56.0], [233.0, 50.0]], ('12.4', 0.9943134188652039)], [[[403.0, 28.0], [428.0, 28.0], [428.0, 49.0], [403.0, 49.0]], ('12', 0.9996165037155151)], [[[14.0, 69.0], [45.0, 73.0], [42.0, 96.0], [10.0, 91.0]], ('11.7', 0.9524601101875305)], [[[647.0, 63.0], [683.0, 70.0], [680.0, 92.0], [643.0, 86.0]], ('12.2', 0.9974004626274109)], [[[772.0, 79.0], [806.0, 85.0], [802.0, 106.0], [768.0, 100.0]], ('12.6', 0.9969339370727539)], [[[321.0, 109.0], [346.0, 109.0], [346.0, 131.0], [321.0, 131.0]], ('12', 0.9994945526123047)], [[[505.0, 106.0], [531.0, 106.0], [531.0, 128.0], [505.0, 128.0]], ('12', 0.9994453191757202)], [[[131.0, 129.0], [164.0, 129.0], [164.0, 153.0], [131.0, 153.0]], ('11.7', 0.9800257682800293)], [[[400.0, 142.0], [432.0, 147.0], [429.0, 168.0], [397.0, 164.0]], ('11.7', 0.9259808659553528)], [[[574.0, 143.0], [611.0, 146.0], [610.0, 169.0], [572.0, 166.0]], ('12.4', 0.9987472891807556)], [[[255.0, 170.0], [277.0, 170.0], [277.0, 188.0], [255.0, 188.0]], ('12', 0.9993113279342651)], [[[705.0, 166.0], [740.0, 172.0], [736.0, 196.0], [701.0, 190.0]], ('12.6', 0.9992864727973938)], [[[831.0, 161.0], [865.0, 168.0], [861.0, 189.0], [828.0, 183.0]], ('12.6', 0.9958174228668213)], [[[505.0, 218.0], [530.0, 218.0], [530.0, 239.0], [505.0, 239.0]], ('12', 0.9995774030685425)], [[[602.0, 230.0], [636.0, 236.0], [632.0, 258.0], [598.0, 252.0]], ('12.4', 0.9930214285850525)], [[[27.0, 238.0], [59.0, 246.0], [54.0, 266.0], [23.0, 258.0]], ('11.8', 0.8212630748748779)], [[[337.0, 237.0], [371.0, 246.0], [366.0, 266.0], [332.0, 257.0]], ('12.4', 0.9973967671394348)], [[[753.0, 249.0], [785.0, 252.0], [783.0, 273.0], [751.0, 270.0]], ('12.8', 0.9726212024688721)], [[[247.0, 296.0], [282.0, 303.0], [278.0, 326.0], [243.0, 320.0]], ('12.2', 0.9990389943122864)], [[[112.0, 309.0], [145.0, 315.0], [141.0, 336.0], [108.0, 330.0]], ('11.8', 0.8621516227722168)], [[[690.0, 308.0], [725.0, 314.0], [721.0, 337.0], [685.0, 331.0]], ('12.8', 0.9702611565589905)], [[[822.0, 311.0], [857.0, 317.0], [853.0, 340.0], [818.0, 334.0]], ('12.8', 0.9512612819671631)], [[[432.0, 330.0], [468.0, 335.0], [464.0, 360.0], [429.0, 355.0]], ('12.2', 0.998501718044281)], [[[530.0, 326.0], [564.0, 330.0], [562.0, 354.0], [528.0, 351.0]], ('12.2', 0.9964764714241028)], [[[311.0, 361.0], [347.0, 367.0], [343.0, 390.0], [307.0, 384.0]], ('12.5', 0.9912349581718445)], [[[160.0, 387.0], [195.0, 387.0], [195.0, 412.0], [160.0, 412.0]], ('12.2', 0.9976766109466553)], [[[47.0, 409.0], [72.0, 412.0], [70.0, 434.0], [45.0, 432.0]], ('12', 0.9998159408569336)], [[[755.0, 405.0], [789.0, 408.0], [787.0, 432.0], [752.0, 429.0]], ('12.8', 0.9887421131134033)], [[[509.0, 431.0], [545.0, 438.0], [540.0, 462.0], [505.0, 456.0]], ('12.2', 0.9987369179725647)], [[[637.0, 430.0], [673.0, 436.0], [670.0, 460.0], [633.0, 454.0]], ('12.4', 0.9981961846351624)], [[[232.0, 446.0], [267.0, 452.0], [263.0, 475.0], [228.0, 469.0]], ('12.2', 0.9978774189949036)], [[[366.0, 449.0], [402.0, 454.0], [399.0, 478.0], [363.0, 473.0]], ('12.6', 0.9988245368003845)], [[[130.0, 488.0], [162.0, 488.0], [162.0, 513.0], [130.0, 513.0]], ('11.9', 0.8871479034423828)], [[[692.0, 496.0], [728.0, 501.0], [725.0, 524.0], [689.0, 519.0]], ('12.8', 0.9953797459602356)], [[[298.0, 509.0], [331.0, 509.0], [331.0, 535.0], [298.0, 535.0]], ('12.1', 0.9965022206306458)], [[[569.0, 515.0], [606.0, 520.0], [603.0, 544.0], [566.0, 539.0]], ('12.4', 0.9974331855773926)], [[[822.0, 513.0], [856.0, 519.0], [852.0, 540.0], [819.0, 534.0]], ('12.8', 0.8751859664916992)], [[[449.0, 525.0], [474.0, 525.0], [474.0, 547.0], [449.0, 547.0]], ('12', 0.9995641112327576)]]
+        self.ocr_results = self.results_for(image_path)
         if self.ocr_results is not None:
-            for res in self.ocr_results:
-                value = res[1][0]
-                coords = res[0]
-                x, y = int(coords[0][0]), int(coords[0][1])
-                x1, y1 = int(coords[2][0]), int(coords[2][1])
-                cv2.rectangle(self.cvimg, (x, y), (x1, y1), (0, 0, 255), 2)
-                # cv2.rectangle(self.cvimg, (x - 3, y - 3), (x1 + 3, y1 + 3), (0, 0, 255), 2)
-                self.listWidget_rec.addItem(value)
-                self.listWidget_coor.addItem(f"{coords}")
+            self.listWidget_rec.addItems(self.ocr_results.texts)
+            self.listWidget_coor.addItems([f"{coords}" for coords in self.ocr_results.boxes.tolist()])
         self.btn_saveImg.setEnabled(True)
         self.btn_saveData.setEnabled(True)
         self.btn_rerec.setEnabled(True)
     
+    def showPage(self, index):
+        self.current_index = index
+        self.update_image_label()
+        self.updateCurrentCanvas(self.imgs_pathsList[index])
+
+    def update_image_label(self):
+        image_name = self.imgs_pathsList[self.current_index].split('/')[-1]
+        if self.imgs_pathsList[self.current_index] in self.changed_paths:
+            image_name += " | изменено после сохранения сеанса"
+        self.imgName_label.setText(f"№ {self.current_index + 1} | {image_name}")
+
     def showPrevious(self):
-        self.current_index = self.stackedWid_images.currentIndex()
-        previous_index = self.current_index - 1
-        if previous_index >= 0:
-            self.stackedWid_images.setCurrentIndex(previous_index)
-        else:
-            previous_index = self.stackedWid_images.count() - 1
-            self.stackedWid_images.setCurrentIndex(previous_index)
-        image_name = self.imgs_pathsList[previous_index].split('/')[-1]
-        self.imgName_label.setText(f"№ {previous_index + 1} | {image_name}")
-        self.updateCurrentCanvas(self.imgs_pathsList[previous_index])
+        self.showPage((self.current_index - 1) % len(self.imgs_pathsList))
 
     def showNext(self):
-        self.current_index = self.stackedWid_images.currentIndex()
-        next_index = self.current_index + 1
-        if next_index < self.stackedWid_images.count():
-            self.stackedWid_images.setCurrentIndex(next_index)
-        else:
-            next_index = 0
-            self.stackedWid_images.setCurrentIndex(next_index)
-        image_name = self.imgs_pathsList[next_index].split('/')[-1]
-        self.imgName_label.setText(f"№ {next_index + 1} | {image_name}")
-        self.updateCurrentCanvas(self.imgs_pathsList[next_index])
+        self.showPage((self.current_index + 1) % len(self.imgs_pathsList))
     
     def saveData_clicked(self):
-        selected_directory = QFileDialog.getExistingDirectory(self, "Выберите папку для сохранения результатов")
-        if selected_directory and self.results_dic:
-            for img_path, results in self.results_dic.items():
-                img_name = os.path.basename(img_path)
-                txt_file_name = f"{os.path.splitext(img_name)[0]}_ocrRes.txt"
-                save_directory = os.path.join(selected_directory, txt_file_name)
-                with open(f"{save_directory}", 'w+', encoding='utf-8') as file:
-                    for result in results:
-                        value = result[1][0]
-                        coords = result[0]
-                        file.write(f"{value}\t{coords}\n")
-            QMessageBox.information(self, "Информация", f"Результаты успешно сохранены в\n{selected_directory}")
+        # Все результаты в один файл-таблицу; прежний вариант - по текстовому файлу на изображение
+        save_path, selected_filter = QFileDialog.getSaveFileName(
+            self, "Сохранить результаты", "ocrRes.csv",
+            "CSV (*.csv);;JSON Lines (*.jsonl);;Parquet (*.parquet);;Feather (*.feather);;Текст по изображениям (*_ocrRes.txt)")
+        if save_path and self.results_dic:
+            if selected_filter.startswith("Текст"):
+                selected_directory = os.path.dirname(save_path)
+                for img_path, results in self.results_dic.items():
+                    img_name = os.path.basename(img_path)
+                    txt_file_name = f"{os.path.splitext(img_name)[0]}_ocrRes.txt"
+                    save_directory = os.path.join(selected_directory, txt_file_name)
+                    with open(f"{save_directory}", 'w+', encoding='utf-8') as file:
+                        for value, coords in zip(results.texts, results.boxes.tolist()):
+                            file.write(f"{value}\t{coords}\n")
+                QMessageBox.information(self, "Информация", f"Результаты успешно сохранены в\n{selected_directory}")
+                return
+            if not save_path.lower().endswith(EXPORT_FORMATS):
+                save_path += selected_filter[selected_filter.index("*") + 1:-1]
+            try:
+                # Изображения в списке уже распознаны: без результатов - значит, текст не найден
+                empty = ImageResults.from_arrays([], [], [])
+                write_results(save_path, self.imgs_pathsList,
+                              {img_path: self.results_dic.get(img_path, empty) for img_path in self.imgs_pathsList})
+            except Exception as e:
+                print("Ошибка сохранения результатов", save_path, e)
+                QMessageBox.warning(self, "Информация", f"Результаты не сохранены!\n{e}")
+                return
+            QMessageBox.information(self, "Информация", f"Результаты успешно сохранены в\n{save_path}")
         else:
             QMessageBox.warning(self, "Информация", f"Результаты не сохранены!")
     
     def saveImg_clicked(self):
-        selected_directory = QFileDialog.getExistingDirectory(self, "Выберите папку для сохранения результатов")
-        if selected_directory and not self.cvimg is None:
-            for img_path, _ in self.results_dic.items():
-                img_name = os.path.basename(img_path)
-                img_name = f"{os.path.splitext(img_name)[0]}_ocrRes.png"
-                save_directory = os.path.join(selected_directory, img_name)
-                cv2.imencode('.png', self.cvimg)[1].tofile(f"{save_directory}")
-            QMessageBox.information(self, "Информация", f"Изображения успешно сохранены в\n{selected_directory}")
-        else:
+        if self.exportWorker is not None and self.exportWorker.isRunning():
+            self.statusBar().showMessage("Дождитесь окончания сохранения изображений", 5000)
+            return
+        # Полоса прогресса и кнопка отмены общие с распознаванием
+        if any(worker is not None and worker.isRunning() for worker in (self.ocrWorker, self.rerecWorker)):
+            self.statusBar().showMessage("Дождитесь окончания текущего распознавания", 5000)
+            return
+        dialog = ExportDialog(self, self.export_directory)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        selected_directory = dialog.directory.text()
+        if not selected_directory or not os.path.isdir(selected_directory) or self.current_index < 0:
             QMessageBox.warning(self, "Информация", f"Изображения не сохранены!")
+            return
+        self.export_directory = selected_directory
+        if dialog.scope.currentIndex() == 0:
+            export_pathsList = [self.imgs_pathsList[self.current_index]]
+        else:
+            export_pathsList = list(self.imgs_pathsList)
+        results_dic = {image_path: self.results_for(image_path) for image_path in export_pathsList}
+        self.exportWorker = ExportWorker(export_pathsList, results_dic, selected_directory,
+                                         IMAGE_FORMATS[dialog.format.currentIndex()], dialog.quality.value(),
+                                         dialog.labels.currentIndex() == 0)
+        self.exportWorker.progressBarValue.connect(self.statusProgress.setValue)
+        self.exportWorker.finished.connect(self.handleExportFinished)
+        self.statusProgress.setFormat("Сохранение: %v из %m")
+        self.statusProgress.setRange(0, len(export_pathsList))
+        self.statusProgress.setValue(0)
+        self.statusProgress.show()
+        self.btn_cancelOcr.show()
+        self.exportWorker.start()
+
+    def handleExportFinished(self):
+        worker = self.exportWorker
+        self.statusProgress.hide()
+        self.statusProgress.setFormat("Распознавание: %v из %m")
+        if not self.pending_pathsList:
+            self.btn_cancelOcr.hide()
+        # Изображения, выбранные во время сохранения
+        worker.wait()
+        self.start_waiting()
+        message = f"Сохранено изображений: {worker.saved} в\n{worker.directory}"
+        if worker.failed:
+            message += f"\nНе сохранено: {worker.failed}"
+        if worker.control.cancelled:
+            message = "Сохранение прервано.\n" + message
+        QMessageBox.information(self, "Информация", message)
 
 
 
@@ -379,6 +1491,10 @@ def main():
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
+    # Файл сеанса можно передать в командной строке
+    for path in sys.argv[1:]:
+        if path.lower().endswith(SESSION_EXTENSION):
+            window.open_session(path)
     return app.exec()
 
 if __name__ == '__main__':
@@ -176,8 +176,7 @@ class AutoDialog(QDialog):
         print("reject")
         self.thread_1.handle = -1
         self.thread_1.quit()
-        while not self.thread_1.isFinished():
-            pass
+        self.thread_1.wait()
         self.accept()
 
     def validate(self):
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import argparse
+from OcrEngine import (create_ocr, ocr_image, IMAGE_EXTENSIONS, TILE_SIZE, TILE_OVERLAP, REC_BATCH_NUM,
+                       REC_BATCH_IMAGES)
+from OcrPool import OcrPool, DEFAULT_PROCESSES, DEFAULT_THREADS, START_METHOD
+from OcrCache import OcrCache, CACHE_PATH, CACHE_MAX_MB
+from OcrPipeline import OcrPipeline, PIPELINE_READERS, PIPELINE_QUEUE
+from OcrExport import ResultWriter, export_format
+from ImageExport import export_images, IMAGE_FORMATS, EXPORT_QUALITY, EXPORT_PROCESSES
+
+
+def collect_images(paths, list_files=(), recursive=False):
+    imgs_pathsList = []
+    paths = list(paths)
+    for list_file in list_files:
+        with open(list_file, 'r', encoding='utf-8') as file:
+            paths.extend(line.strip() for line in file if line.strip())
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                found = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+            else:
+                found = [os.path.join(path, name) for name in os.listdir(path)]
+            imgs_pathsList.extend(sorted(p for p in found if p.lower().endswith(IMAGE_EXTENSIONS)))
+        else:
+            imgs_pathsList.append(path)
+    return imgs_pathsList
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетное распознавание глубин без графического интерфейса")
+    parser.add_argument("paths", nargs="*", help="изображения или папки с изображениями")
+    parser.add_argument("-l", "--list", dest="list_files", action="append", default=[],
+                        help="текстовый файл со списком путей (по одному на строку)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="искать изображения во вложенных папках")
+    parser.add_argument("-o", "--output", default="ocrRes.jsonl", help="файл результатов JSONL")
+    parser.add_argument("-e", "--export",
+                        help="дополнительно записать таблицу результатов (.csv, .jsonl, .parquet или .feather)")
+    parser.add_argument("--annotate", help="папка для изображений с рамками и текстом результатов")
+    parser.add_argument("--image-format", choices=[ext[1:] for ext in IMAGE_FORMATS], default="png",
+                        help="формат изображений с рамками")
+    parser.add_argument("--quality", type=int, default=EXPORT_QUALITY,
+                        help="качество JPEG и WebP (1-100, 101 - WebP без потерь)")
+    parser.add_argument("-j", "--processes", type=int, default=DEFAULT_PROCESSES,
+                        help="число процессов распознавания (0 - по числу ядер)")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS,
+                        help="число потоков PaddleOCR на процесс (0 - ядра поровну между процессами)")
+    parser.add_argument("--start", choices=("spawn", "forkserver"), default=START_METHOD,
+                        help="способ запуска процессов: forkserver загружает модели один раз и делит их между процессами")
+    parser.add_argument("--tile", type=int, default=TILE_SIZE,
+                        help="сторона фрагмента для мозаичного распознавания больших карт (0 - выключено)")
+    parser.add_argument("--tile-overlap", type=int, default=TILE_OVERLAP, help="перекрытие фрагментов в пикселях")
+    parser.add_argument("--cache", default=CACHE_PATH, help="файл кэша результатов распознавания")
+    parser.add_argument("--cache-mb", type=int, default=CACHE_MAX_MB,
+                        help="предельный размер кэша в мегабайтах (0 - без кэша)")
+    parser.add_argument("--no-pipeline", dest="pipeline", action="store_false",
+                        help="в одном процессе распознавать изображения по одному, без конвейера стадий")
+    parser.add_argument("--readers", type=int, default=PIPELINE_READERS, help="число потоков чтения в конвейере")
+    parser.add_argument("--queue", type=int, default=PIPELINE_QUEUE, help="длина очередей между стадиями конвейера")
+    parser.add_argument("--rec-batch", type=int, default=REC_BATCH_NUM, help="размер пакета распознавания")
+    parser.add_argument("--rec-batch-images", type=int, default=REC_BATCH_IMAGES,
+                        help="число изображений, фрагменты которых распознаются общими пакетами (1 - по одному)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="не выводить журнал PaddleOCR")
+    return parser.parse_args(argv)
+
+
+def iter_results(imgs_pathsList, args, cache=None):
+    if args.processes != 1:
+        with OcrPool(args.processes, args.threads, args.tile, args.tile_overlap, cache,
+                     start_method=args.start, rec_batch_num=args.rec_batch) as pool:
+            yield from pool.imap(imgs_pathsList)
+        return
+    kwargs = {"cpu_threads": args.threads} if args.threads else {}
+    ocr = create_ocr(show_log=not args.quiet, rec_batch_num=args.rec_batch, **kwargs)
+    for Imgpath in imgs_pathsList:
+        try:
+            yield Imgpath, ocr_image(ocr, Imgpath, args.tile, args.tile_overlap, cache)
+        except Exception as e:
+            print("Ошибка распознавания", Imgpath, e)
+            yield Imgpath, None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.processes = args.processes or os.cpu_count() or 1
+    imgs_pathsList = collect_images(args.paths, args.list_files, args.recursive)
+    if not imgs_pathsList:
+        print("Не найдено изображений для распознавания.")
+        return 1
+
+    if args.export:
+        try:
+            export_format(args.export)
+        except ValueError as e:
+            print(e)
+            return 1
+
+    cache = OcrCache(args.cache, args.cache_mb) if args.cache_mb > 0 else None
+    pipeline = None
+    if args.processes == 1 and args.pipeline:
+        kwargs = {"cpu_threads": args.threads} if args.threads else {}
+        pipeline = OcrPipeline(create_ocr(show_log=not args.quiet, rec_batch_num=args.rec_batch, **kwargs),
+                               args.readers, args.queue, args.tile, args.tile_overlap, cache,
+                               batch_images=args.rec_batch_images)
+        results = pipeline.run(imgs_pathsList)
+    else:
+        results = iter_results(imgs_pathsList, args, cache)
+
+    findex = 0
+    time_start = time.time()
+    export = ResultWriter(args.export) if args.export else None
+    annotated = {} if args.annotate else None
+    with open(args.output, 'w', encoding='utf-8') as out:
+        for Imgpath, result_dic in results:
+            if not result_dic:
+                print('Не удалось распознать изображение', Imgpath)
+            out.write(json.dumps({"image": Imgpath, "results": result_dic.to_list() if result_dic else []}, ensure_ascii=False) + '\n')
+            out.flush()
+            if export is not None:
+                export.write(Imgpath, result_dic)
+            if annotated is not None:
+                annotated[Imgpath] = result_dic
+            findex += 1
+            if pipeline is not None:
+                depths = " ".join(f"{stage}={n}" for stage, n in pipeline.depths().items())
+                print(f"[{findex}/{len(imgs_pathsList)}] {Imgpath}  очереди: {depths}")
+            else:
+                print(f"[{findex}/{len(imgs_pathsList)}] {Imgpath}")
+    elapsed = time.time() - time_start
+    print(f"Обработано изображений: {findex} за {elapsed:.1f} с ({findex / max(elapsed, 1e-9):.2f} изобр./с)")
+    if pipeline is not None:
+        print("Время работы стадий, с:", " ".join(f"{stage}={t:.1f}" for stage, t in pipeline.busy.items()))
+    print(f"Результаты сохранены в {args.output}")
+    if export is not None:
+        export.close()
+        print(f"Таблица результатов ({export.rows} строк) сохранена в {args.export}")
+    if annotated is not None:
+        # Изображения с рамками рисуются после распознавания, в процессах по числу ядер
+        os.makedirs(args.annotate, exist_ok=True)
+        time_start = time.time()
+        saved = 0
+        for findex, (Imgpath, out_path) in enumerate(export_images(list(annotated), annotated, args.annotate,
+                                                                   "." + args.image_format, args.quality,
+                                                                   processes=EXPORT_PROCESSES), 1):
+            saved += out_path is not None
+            if findex % 100 == 0 or findex == len(annotated):
+                print(f"Сохранено изображений с рамками: {findex}/{len(annotated)}")
+        print(f"Изображения с рамками ({saved}) сохранены в {args.annotate} за {time.time() - time_start:.1f} с")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
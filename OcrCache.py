@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from OcrEngine import DET_MODEL_DIR, REC_MODEL_DIR, MAX_TEXT_LENGTH, OCR_PARAMS
+from OcrResults import ImageResults
+
+CACHE_PATH = os.environ.get("LOCMAP_OCR_CACHE", os.path.join(os.path.expanduser("~"), ".locmap", "ocr_cache.sqlite3"))
+# Предельный размер кэша в мегабайтах, 0 - кэш выключен
+CACHE_MAX_MB = int(os.environ.get("LOCMAP_OCR_CACHE_MB", 512))
+
+
+class OcrCache:
+    # Результаты распознавания на диске по хэшу содержимого изображения и настроек OCR.
+    # SQLite в режиме WAL позволяет нескольким процессам читать и писать одновременно.
+    def __init__(self, path=CACHE_PATH, max_mb=CACHE_MAX_MB, det_model_dir=DET_MODEL_DIR,
+                 rec_model_dir=REC_MODEL_DIR, max_text_length=MAX_TEXT_LENGTH, **params):
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        settings = {"det_model_dir": os.path.abspath(det_model_dir),
+                    "rec_model_dir": os.path.abspath(rec_model_dir),
+                    "max_text_length": max_text_length, "format": 2, **OCR_PARAMS, **params}
+        self.settings = json.dumps(settings, sort_keys=True).encode('utf-8')
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        # Отдельное соединение на каждый поток
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                       "size INTEGER NOT NULL, atime REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS results_atime ON results(atime)")
+            # Общий размер записей хранится отдельно, чтобы не суммировать таблицу при каждой записи
+            db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            if db.execute("SELECT 1 FROM meta WHERE name = 'size'").fetchone() is None:
+                db.execute("INSERT OR IGNORE INTO meta (name, value) "
+                           "SELECT 'size', COALESCE(SUM(size), 0) FROM results")
+            self._local.db = db
+        return db
+
+    def key(self, data, *extra):
+        h = hashlib.sha256(self.settings)
+        h.update(json.dumps(extra).encode('utf-8'))
+        h.update(memoryview(data))
+        return h.hexdigest()
+
+    def get(self, key):
+        # (найдено, результат); результат None - изображение слишком мало
+        row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        self.db.execute("UPDATE results SET atime = ? WHERE key = ?", (time.time(), key))
+        return True, ImageResults.from_bytes(row[0]) if row[0] else None
+
+    def put(self, key, result_dic):
+        # Запись, общий размер и вытеснение - одна короткая транзакция
+        value = result_dic.to_bytes() if result_dic is not None else b""
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            old = db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            db.execute("INSERT OR REPLACE INTO results (key, value, size, atime) VALUES (?, ?, ?, ?)",
+                       (key, value, len(value), time.time()))
+            total = self._add_size(len(value) - (old[0] if old else 0))
+            if total > self.max_bytes:
+                self.evict(total - self.max_bytes)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def _add_size(self, delta):
+        self.db.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (delta,))
+        return self.db.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def evict(self, excess):
+        # Удаление давно не использованных записей общим размером не меньше excess;
+        # вызывается внутри транзакции put, записи читаются по индексу atime
+        stale, freed = [], 0
+        for key, size in self.db.execute("SELECT key, size FROM results ORDER BY atime"):
+            if freed >= excess:
+                break
+            stale.append((key,))
+            freed += size
+        self.db.executemany("DELETE FROM results WHERE key = ?", stale)
+        self._add_size(-freed)
+
+    def clear(self):
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DELETE FROM results")
+        db.execute("UPDATE meta SET value = 0 WHERE name = 'size'")
+        db.execute("COMMIT")
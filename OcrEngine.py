@@ -0,0 +1,346 @@
+import os
+import threading
+import cv2
+import numpy as np
+from ImageStore import read_bytes, decode_image, image_size, open_source, as_source, RasterSource
+from OcrResults import ImageResults
+from SpatialIndex import BoxIndex
+
+DET_MODEL_DIR = "models/det/en_PP-OCRv3_det_infer"
+REC_MODEL_DIR = "models/rec/en_PP-OCRv4_rec_infer"
+CLS_MODEL_DIR = "models/cls"
+MAX_TEXT_LENGTH = 5
+MIN_IMAGE_SIDE = 32
+# Параметры вызова PaddleOCR.ocr, с которыми работает приложение
+OCR_PARAMS = {"cls": False, "bin": False, "inv": False}
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+# Мозаичный режим для больших карт: 0 - выключен, иначе сторона фрагмента в пикселях
+TILE_SIZE = int(os.environ.get("LOCMAP_OCR_TILE", 0))
+TILE_OVERLAP = int(os.environ.get("LOCMAP_OCR_TILE_OVERLAP", 256))
+DUPLICATE_OVERLAP = 0.7
+# Размер пакета распознавания и число изображений, фрагменты которых собираются в общие пакеты
+REC_BATCH_NUM = int(os.environ.get("LOCMAP_REC_BATCH", 32))
+REC_BATCH_IMAGES = int(os.environ.get("LOCMAP_REC_BATCH_IMAGES", 8))
+# Запас вокруг рамки при чтении фрагмента окном (кубическая интерполяция берёт 4x4 пикселя)
+CROP_MARGIN = 4
+# Увеличение выделенной области перед распознаванием: мелкие глубины читаются надёжнее
+ROI_UPSCALE = float(os.environ.get("LOCMAP_ROI_UPSCALE", 2.0))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobControl:
+    # Отмена, пауза и продолжение задания распознавания. Проверка выполняется
+    # между изображениями и между фрагментами; на паузе поток ждёт, не занимая процессор
+    def __init__(self):
+        self.cancelled = False
+        self._running = threading.Event()
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def pause(self):
+        if not self.cancelled:
+            self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self._running.set()
+
+    def checkpoint(self):
+        self._running.wait()
+        if self.cancelled:
+            raise JobCancelled()
+
+
+def create_ocr(show_log=True, det_model_dir=DET_MODEL_DIR, rec_model_dir=REC_MODEL_DIR,
+               cls_model_dir=CLS_MODEL_DIR, max_text_length=MAX_TEXT_LENGTH, rec_batch_num=REC_BATCH_NUM, **kwargs):
+    # paddleocr импортируется только здесь: его загрузка занимает секунды
+    from paddleocr import PaddleOCR
+    return PaddleOCR(show_log=show_log, use_angle_cls=False, lang="en",
+                     det_model_dir=det_model_dir,
+                     rec_model_dir=rec_model_dir,
+                     cls_model_dir=cls_model_dir,
+                     use_pdserving=False,
+                     max_text_length=max_text_length,
+                     rec_batch_num=rec_batch_num,
+                     **kwargs)
+
+
+def warmup(ocr):
+    # Пробный прогон на пустом изображении: первые вызовы предсказателей
+    # выделяют память и готовят вычисления, пусть это произойдёт заранее
+    img = np.zeros((MIN_IMAGE_SIDE * 4, MIN_IMAGE_SIDE * 8, 3), dtype=np.uint8)
+    cv2.putText(img, "12", (MIN_IMAGE_SIDE, MIN_IMAGE_SIDE * 3), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+    ocr.ocr(img, **OCR_PARAMS)
+    ocr.text_recognizer([img])
+    return ocr
+
+
+def detect_text(ocr, img):
+    # Только обнаружение: рамки в порядке чтения и вырезанные по ним фрагменты,
+    # так же, как это делает PaddleOCR.ocr
+    dt_boxes, _ = ocr.text_detector(img)
+    if dt_boxes is None or len(dt_boxes) == 0:
+        return [], []
+    from tools.infer.predict_system import sorted_boxes
+    dt_boxes = sorted_boxes(dt_boxes)
+    return dt_boxes, crop_boxes(img, dt_boxes)
+
+
+def recognize_text(ocr, dt_boxes, crops):
+    # Только распознавание готовых фрагментов; результаты с низкой вероятностью отбрасываются
+    return recognize_batch(ocr, [(dt_boxes, crops)])[0]
+
+
+def recognize_batch(ocr, items):
+    # Распознавание фрагментов нескольких изображений одним вызовом: распознаватель
+    # сортирует все фрагменты по ширине и делит на пакеты по rec_batch_num, так что
+    # изображения с немногими глубинами не дают маленьких пакетов. Результаты
+    # раскладываются обратно по изображениям в исходном порядке.
+    all_crops = [crop for _, crops in items for crop in crops]
+    if not all_crops:
+        return [[] for _ in items]
+    rec_res, _ = ocr.text_recognizer(all_crops)
+    raw_results = []
+    start = 0
+    for dt_boxes, crops in items:
+        recs = rec_res[start:start + len(crops)]
+        start += len(crops)
+        raw_results.append([[np.asarray(box).tolist(), tuple(rec)] for box, rec in zip(dt_boxes, recs)
+                            if rec[1] >= ocr.drop_score])
+    return raw_results
+
+
+def poly_to_bbox(poly):
+    x1 = np.min([p[0] for p in poly])
+    x2 = np.max([p[0] for p in poly])
+    y1 = np.min([p[1] for p in poly])
+    y2 = np.max([p[1] for p in poly])
+    return [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]
+
+
+def is_sounding(value):
+    return len([c for c in value if c.isalpha()]) < 2 and any(c.isdigit() for c in value)
+
+
+def sounding_mask(texts):
+    # is_sounding для всех строк сразу: классы символов определяются один раз
+    # для каждого различного символа, затем подсчитываются по накопленным суммам
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+    codes = np.frombuffer("".join(texts).encode('utf-32-le'), dtype=np.uint32)
+    chars, inverse = np.unique(codes, return_inverse=True)
+    alpha = np.array([chr(c).isalpha() for c in chars], dtype=np.int64)[inverse]
+    digit = np.array([chr(c).isdigit() for c in chars], dtype=np.int64)[inverse]
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    alpha_cs = np.concatenate(([0], np.cumsum(alpha)))
+    digit_cs = np.concatenate(([0], np.cumsum(digit)))
+    return (alpha_cs[ends] - alpha_cs[starts] < 2) & (digit_cs[ends] - digit_cs[starts] > 0)
+
+
+def postprocess(raw_results, Iw, Ih):
+    # Выравнивание рамок по осям, расширение узких рамок на 3 px и отбор глубин
+    # над всеми рамками изображения сразу. Ширина и высота, как и прежде, берутся
+    # по исходным углам рамки: (1)-(0) по x и (3)-(2) по y.
+    if not raw_results:
+        return ImageResults.from_list([])
+    P = np.array([res[0] for res in raw_results], dtype=np.float64).reshape(-1, 4, 2)
+    texts = [res[1][0] for res in raw_results]
+    keep = sounding_mask(texts)
+    if not keep.any():
+        return ImageResults.from_list([])
+    P = P[keep]
+    boxes = P.copy()
+    aligned = (P[:, 0, 0] == P[:, 3, 0]) & (P[:, 1, 0] == P[:, 2, 0]) & \
+              (P[:, 0, 1] == P[:, 1, 1]) & (P[:, 2, 1] == P[:, 3, 1])
+    x1, y1 = P[:, :, 0].min(1), P[:, :, 1].min(1)
+    x2, y2 = P[:, :, 0].max(1), P[:, :, 1].max(1)
+    bbox = np.stack([np.stack([x1, y1], 1), np.stack([x2, y1], 1),
+                     np.stack([x2, y2], 1), np.stack([x1, y2], 1)], 1)
+    boxes[~aligned] = bbox[~aligned]
+
+    narrow = P[:, 1, 0] - P[:, 0, 0] < 20
+    left, right = np.maximum(0, P[:, 0, 0] - 3), np.minimum(P[:, 1, 0] + 3, Iw)
+    boxes[narrow, 0, 0] = boxes[narrow, 3, 0] = left[narrow]
+    boxes[narrow, 1, 0] = boxes[narrow, 2, 0] = right[narrow]
+    short = P[:, 3, 1] - P[:, 2, 1] < 20
+    top, bottom = np.maximum(0, P[:, 0, 1] - 3), np.minimum(P[:, 2, 1] + 3, Ih)
+    boxes[short, 0, 1] = boxes[short, 1, 1] = top[short]
+    boxes[short, 2, 1] = boxes[short, 3, 1] = bottom[short]
+
+    kept = [res[1] for res, k in zip(raw_results, keep) if k]
+    return ImageResults.from_arrays(boxes, [rec[0] for rec in kept], [rec[1] for rec in kept])
+
+
+def crop_boxes(img, boxes):
+    # Пакет tools доступен после импорта paddleocr в create_ocr.
+    # Из RasterSource читается только окно вокруг каждой рамки с запасом CROP_MARGIN
+    # для интерполяции; для рамок, выровненных по осям, фрагменты те же, что из изображения целиком
+    from tools.infer.utility import get_rotate_crop_image
+    if not isinstance(img, RasterSource):
+        return [get_rotate_crop_image(img, np.array(box, dtype=np.float32)) for box in boxes]
+    crops = []
+    for box in boxes:
+        box = np.array(box, dtype=np.float32)
+        x0, y0, x1, y1 = img.clip(*(np.floor(box.min(0)) - CROP_MARGIN), *(np.ceil(box.max(0)) + CROP_MARGIN))
+        crops.append(get_rotate_crop_image(img.read(x0, y0, x1, y1), box - np.float32([x0, y0])))
+    return crops
+
+
+def rerecognize(ocr, items):
+    # Повторное распознавание по сохранённым рамкам без обнаружения.
+    # items - список (изображение, ImageResults); рамки не меняются,
+    # остаются только результаты, которые по-прежнему похожи на глубины
+    raw_batch = recognize_batch(ocr, [(result_dic.boxes, crop_boxes(img, result_dic.boxes))
+                                      for img, result_dic in items])
+    results = []
+    for raw_results in raw_batch:
+        result_dic = ImageResults.from_list(raw_results)
+        results.append(result_dic.select(sounding_mask(result_dic.texts)) if len(result_dic) else result_dic)
+    return results
+
+
+def _tile_spans(length, tile_size, overlap):
+    # Начало фрагмента и его "собственная" зона, граница которой проходит по середине перекрытия
+    if length <= tile_size:
+        return [(0, length, 0, length)]
+    starts = list(range(0, length - tile_size, tile_size - overlap)) + [length - tile_size]
+    spans = []
+    for i, start in enumerate(starts):
+        own_start = 0 if i == 0 else (starts[i - 1] + tile_size + start) / 2
+        own_end = length if i == len(starts) - 1 else (start + tile_size + starts[i + 1]) / 2
+        spans.append((start, start + tile_size, own_start, own_end))
+    return spans
+
+
+def tile_grid(Iw, Ih, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    overlap = min(overlap, tile_size // 2)
+    return [(x0, y0, x1, y1, ox0, oy0, ox1, oy1)
+            for y0, y1, oy0, oy1 in _tile_spans(Ih, tile_size, overlap)
+            for x0, x1, ox0, ox1 in _tile_spans(Iw, tile_size, overlap)]
+
+
+def detect_tile(ocr, tile_img, tile):
+    # Обнаружение во фрагменте: рамки переводятся в координаты всего изображения,
+    # остаются только те, центр которых лежит в собственной зоне фрагмента
+    x0, y0, _, _, ox0, oy0, ox1, oy1 = tile
+    dt_boxes, crops = detect_text(ocr, tile_img)
+    if len(dt_boxes) == 0:
+        return [], []
+    boxes = np.asarray(dt_boxes, dtype=np.float64) + (x0, y0)
+    centres = boxes.mean(1)
+    own = (centres[:, 0] >= ox0) & (centres[:, 0] < ox1) & (centres[:, 1] >= oy0) & (centres[:, 1] < oy1)
+    return list(boxes[own]), [crop for crop, k in zip(crops, own) if k]
+
+
+def ocr_tile(ocr, tile_img, tile):
+    return recognize_text(ocr, *detect_tile(ocr, tile_img, tile))
+
+
+def suppress_duplicates(raw_results, tiles, overlap=TILE_OVERLAP):
+    # Крупные надписи могут попасть в собственные зоны двух фрагментов;
+    # среди рамок у границ зон оставляется рамка с большей вероятностью
+    if len(raw_results) < 2:
+        return raw_results
+    boxes = np.array([res[0] for res in raw_results], dtype=np.float64)
+    x1, y1 = boxes[:, :, 0].min(1), boxes[:, :, 1].min(1)
+    x2, y2 = boxes[:, :, 0].max(1), boxes[:, :, 1].max(1)
+    borders_x = sorted({t[4] for t in tiles} - {0})
+    borders_y = sorted({t[5] for t in tiles} - {0})
+    near = np.zeros(len(raw_results), dtype=bool)
+    for b in borders_x:
+        near |= (x1 < b + overlap / 2) & (x2 > b - overlap / 2)
+    for b in borders_y:
+        near |= (y1 < b + overlap / 2) & (y2 > b - overlap / 2)
+    areas = np.maximum(x2 - x1, 1) * np.maximum(y2 - y1, 1)
+    scores = np.array([res[1][1] for res in raw_results])
+    keep = np.ones(len(raw_results), dtype=bool)
+    candidates = np.flatnonzero(near)
+    # Пересекающиеся рамки ищутся по индексу, а не перебором всех рамок у границ
+    index = BoxIndex(np.stack([x1, y1, x2, y2], axis=1)[candidates])
+    for j in np.argsort(-scores[candidates]):
+        i = candidates[j]
+        if not keep[i]:
+            continue
+        others = candidates[index.overlapping(j)]
+        others = others[keep[others]]
+        iw = np.minimum(x2[i], x2[others]) - np.maximum(x1[i], x1[others])
+        ih = np.minimum(y2[i], y2[others]) - np.maximum(y1[i], y1[others])
+        inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+        keep[others[inter / np.minimum(areas[i], areas[others]) > DUPLICATE_OVERLAP]] = False
+    return [res for res, k in zip(raw_results, keep) if k]
+
+
+def ocr_image_tiled(ocr, img, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, control=None):
+    # img - изображение или RasterSource, из которого читается только окно каждого фрагмента
+    source = as_source(img)
+    Ih, Iw = source.height, source.width
+    overlap = min(overlap, tile_size // 2)
+    tiles = tile_grid(Iw, Ih, tile_size, overlap)
+    raw_results = []
+    for tile in tiles:
+        if control is not None:
+            control.checkpoint()
+        raw_results.extend(ocr_tile(ocr, source.read(*tile[:4]), tile))
+    return postprocess(suppress_duplicates(raw_results, tiles, overlap), Iw, Ih)
+
+
+def ocr_region(ocr, img, x0, y0, x1, y1, upscale=ROI_UPSCALE):
+    # Распознавание только прямоугольной области изображения; рамки возвращаются
+    # в координатах всего изображения. None - область слишком мала
+    source = as_source(img)
+    Ih, Iw = source.height, source.width
+    x0, y0, x1, y1 = source.clip(x0, y0, np.ceil(x1), np.ceil(y1))
+    if min(x1 - x0, y1 - y0) * max(upscale, 1.0) <= MIN_IMAGE_SIDE:
+        return None
+    crop = source.read(x0, y0, x1, y1)
+    if upscale != 1.0:
+        crop = cv2.resize(crop, None, fx=upscale, fy=upscale, interpolation=cv2.INTER_CUBIC)
+    raw_results = [[[[p[0] / upscale + x0, p[1] / upscale + y0] for p in res[0]], res[1]]
+                   for res in ocr.ocr(crop, **OCR_PARAMS)[0] or []]
+    return postprocess(raw_results, Iw, Ih)
+
+
+def replace_region(result_dic, region_results, x0, y0, x1, y1):
+    # Результаты с центром внутри области заменяются новыми
+    if result_dic is None or len(result_dic) == 0:
+        return region_results
+    centres = result_dic.boxes.mean(1)
+    inside = (centres[:, 0] >= x0) & (centres[:, 0] < x1) & (centres[:, 1] >= y0) & (centres[:, 1] < y1)
+    return ImageResults.concat([result_dic.select(~inside), region_results])
+
+
+def ocr_image(ocr, Imgpath, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, cache=None, images=None, control=None):
+    # None - изображение слишком мало для распознавания.
+    # images - ImageCache, через который декодированное изображение передаётся просмотру
+    data = read_bytes(Imgpath)
+    if cache is not None:
+        key = cache.key(data, tile_size, overlap)
+        found, result_dic = cache.get(key)
+        if found:
+            return result_dic
+    Iw, Ih = image_size(Imgpath)
+    if Ih > MIN_IMAGE_SIDE and Iw > MIN_IMAGE_SIDE:
+        # Большие BMP/TIFF распознаются по фрагментам без декодирования растра целиком
+        source = open_source(Imgpath) if tile_size and max(Ih, Iw) > tile_size else None
+        img = source or (images.get(Imgpath, data) if images is not None else decode_image(data))
+        Ih, Iw = img.shape[:2]
+        if tile_size and max(Ih, Iw) > tile_size:
+            result_dic = ocr_image_tiled(ocr, img, tile_size, overlap, control)
+        else:
+            raw_results = ocr.ocr(img, **OCR_PARAMS)[0]
+            result_dic = postprocess(raw_results, Iw, Ih)
+    else:
+        print('Размер изображения', Imgpath, 'очень мал для распознавания.')
+        result_dic = None
+    if cache is not None:
+        cache.put(key, result_dic)
+    return result_dic
@@ -0,0 +1,155 @@
+import os
+import numpy as np
+from OcrResults import ImageResults
+
+# Таблица результатов: изображение, текст, вероятность и вершины рамки (x1, y1 ... x4, y4)
+COORD_COLUMNS = [f"{axis}{i}" for i in range(1, 5) for axis in "xy"]
+COLUMNS = ["image", "text", "confidence"] + COORD_COLUMNS
+EXPORT_FORMATS = (".csv", ".jsonl", ".parquet", ".feather")
+# Сколько строк копится перед записью очередной группы строк Parquet/Feather
+EXPORT_BATCH_ROWS = int(os.environ.get("LOCMAP_EXPORT_BATCH_ROWS", 50000))
+
+
+def export_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат таблицы результатов: {path}")
+    return ext
+
+
+def results_frame(Imgpath, result_dic):
+    # Строки одного изображения. Изображение без найденного текста записывается одной строкой
+    # без рамки с вероятностью 0, ещё не распознанное (None) - такой же строкой без вероятности:
+    # при загрузке оба остаются в списке, но второе будет распознано заново.
+    # pandas загружается при первом экспорте, а не при запуске программы
+    import pandas as pd
+    if result_dic is None or len(result_dic) == 0:
+        texts = [None]
+        scores = np.full(1, np.nan if result_dic is None else 0, dtype=np.float32)
+        coords = np.full((1, 8), np.nan, dtype=np.float32)
+    else:
+        texts, scores = result_dic.texts, result_dic.scores
+        coords = result_dic.boxes.reshape(-1, 8)
+    data = {"image": [Imgpath] * len(scores), "text": texts, "confidence": scores}
+    data.update(zip(COORD_COLUMNS, coords.T))
+    return pd.DataFrame(data, columns=COLUMNS)
+
+
+def _arrow_schema():
+    import pyarrow as pa
+    return pa.schema([("image", pa.string()), ("text", pa.string()), ("confidence", pa.float32())]
+                     + [(column, pa.float32()) for column in COORD_COLUMNS])
+
+
+class ResultWriter:
+    # Запись результатов в один файл по мере поступления. CSV и JSONL дописываются
+    # после каждого изображения; Parquet и Feather пишутся группами строк
+    # по EXPORT_BATCH_ROWS, файл можно прочитать после close()
+    def __init__(self, path):
+        self.path = path
+        self.format = export_format(path)
+        self.rows = 0
+        self.images = 0
+        self._file = None
+        self._writer = None
+        self._pending = []
+        self._pending_rows = 0
+        if self.format in (".csv", ".jsonl"):
+            self._file = open(path, 'w', encoding='utf-8', newline='')
+            self._pending = None
+
+    def write(self, Imgpath, result_dic):
+        frame = results_frame(Imgpath, result_dic)
+        if self.format == ".csv":
+            frame.to_csv(self._file, header=self.images == 0, index=False)
+        elif self.format == ".jsonl":
+            self._file.write(frame.to_json(orient="records", lines=True, force_ascii=False).rstrip("\n") + "\n")
+        else:
+            self._pending.append(frame)
+            self._pending_rows += len(frame)
+            if self._pending_rows >= EXPORT_BATCH_ROWS:
+                self._flush()
+        if self._file is not None:
+            self._file.flush()
+        self.rows += len(frame)
+        self.images += 1
+
+    def _flush(self):
+        import pandas as pd
+        import pyarrow as pa
+        schema = _arrow_schema()
+        if self._writer is None:
+            if self.format == ".parquet":
+                import pyarrow.parquet as pq
+                self._writer = pq.ParquetWriter(self.path, schema)
+            else:
+                # Feather версии 2 - это файл Arrow IPC
+                self._writer = pa.ipc.new_file(self.path, schema)
+        if self._pending:
+            frame = pd.concat(self._pending, ignore_index=True)
+            self._writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+        self._pending = []
+        self._pending_rows = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        elif self._pending is not None:
+            self._flush()
+            self._writer.close()
+            self._writer = None
+            self._pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_results(path, imgs_pathsList, results_dic):
+    with ResultWriter(path) as writer:
+        for Imgpath in imgs_pathsList:
+            writer.write(Imgpath, results_dic.get(Imgpath))
+    return writer.rows
+
+
+def read_table(path):
+    import pandas as pd
+    fmt = export_format(path)
+    numeric = dict.fromkeys(["confidence"] + COORD_COLUMNS, np.float32)
+    if fmt == ".csv":
+        # Тексты читаются как есть: "NA" или "12" не должны превратиться в числа
+        return pd.read_csv(path, dtype={"image": str, "text": str, **numeric}, keep_default_na=False,
+                           na_values=dict.fromkeys(numeric, [""]))
+    if fmt == ".jsonl":
+        return pd.read_json(path, lines=True, dtype={"image": str, "text": str, **numeric}, convert_dates=False)
+    if fmt == ".parquet":
+        return pd.read_parquet(path)
+    return pd.read_feather(path)
+
+
+def read_results(path):
+    # Таблица читается целиком за один раз и делится по изображениям без разбора строк;
+    # возвращает список изображений в порядке файла и словарь результатов,
+    # в котором нет ещё не распознанных изображений
+    import pandas as pd
+    frame = read_table(path)
+    codes, images = pd.factorize(frame["image"])
+    scores = frame["confidence"].to_numpy(dtype=np.float32)
+    boxes = frame[COORD_COLUMNS].to_numpy(dtype=np.float32).reshape(-1, 4, 2)
+    texts = frame["text"].to_numpy(dtype=object)
+    order = np.argsort(codes, kind="stable")
+    # Строки без рамки только отмечают изображение; распознанные изображения - те, у которых есть вероятность
+    processed = np.zeros(len(images), dtype=bool)
+    processed[codes[~np.isnan(scores)]] = True
+    order = order[~np.isnan(boxes[order, 0, 0])]
+    bounds = np.searchsorted(codes[order], np.arange(len(images) + 1))
+    results_dic = {}
+    for k, Imgpath in enumerate(images):
+        if not processed[k]:
+            continue
+        index = order[bounds[k]:bounds[k + 1]]
+        results_dic[Imgpath] = ImageResults.from_arrays(boxes[index], [str(t) for t in texts[index]], scores[index])
+    return list(images), results_dic
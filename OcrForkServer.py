@@ -0,0 +1,32 @@
+import os
+import json
+
+# Модуль загружается сервером процессов (multiprocessing, способ forkserver) до порождения
+# процессов пула: модели читаются один раз, а процессы, порождённые от сервера, получают
+# их готовыми и делят память с сервером, пока не изменят её.
+# Сервер только загружает веса и ничего не распознаёт: потоки OpenMP/MKL появляются при
+# первом распознавании, и fork процесса с уже работающими потоками небезопасен. Потоков
+# вычислений в сервере один; процессы пула задают своё число при каждом распознавании
+# (cpu_math_library_num_threads)
+os.environ["OMP_NUM_THREADS"] = "1"
+os.environ["MKL_NUM_THREADS"] = "1"
+
+import OcrPool
+from OcrEngine import create_ocr
+
+
+def _load():
+    # Параметры записывает процесс, запустивший сервер
+    try:
+        with open(OcrPool.forkserver_config_path(os.getppid()), encoding='utf-8') as file:
+            config = file.read()
+    except OSError:
+        return
+    try:
+        OcrPool._ocr = create_ocr(show_log=False, **json.loads(config))
+        OcrPool._ocr_config = config
+    except Exception as e:
+        print("Сервер процессов: модели не загружены,", e)
+
+
+_load()
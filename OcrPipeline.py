@@ -0,0 +1,243 @@
+import os
+import time
+import queue
+import threading
+from OcrEngine import (detect_text, detect_tile, recognize_batch, postprocess, suppress_duplicates, tile_grid,
+                       JobCancelled, MIN_IMAGE_SIDE, TILE_SIZE, TILE_OVERLAP, REC_BATCH_IMAGES)
+from ImageStore import read_bytes, decode_image, image_size, open_source, as_source
+
+# Число потоков чтения и размер очередей между стадиями
+PIPELINE_READERS = int(os.environ.get("LOCMAP_PIPELINE_READERS", 2))
+PIPELINE_QUEUE = int(os.environ.get("LOCMAP_PIPELINE_QUEUE", 4))
+STAGES = ("decode", "detect", "recognize", "postprocess")
+# Неполный пакет распознавания отправляется, если новых изображений нет дольше
+# REC_BATCH_WAIT_MS или если в нём набралось REC_BATCH_CROPS фрагментов
+REC_BATCH_WAIT_MS = int(os.environ.get("LOCMAP_REC_BATCH_WAIT_MS", 100))
+REC_BATCH_CROPS = int(os.environ.get("LOCMAP_REC_BATCH_CROPS", 2048))
+
+
+class OcrPipeline:
+    # Распознавание как конвейер: чтение и декодирование -> обнаружение -> распознавание ->
+    # постобработка. Каждая стадия работает в своём потоке (чтение - в нескольких),
+    # между стадиями ограниченные очереди, поэтому быстрая стадия ждёт медленную,
+    # а чтение с диска идёт одновременно с работой моделей.
+    # Стадия распознавания собирает фрагменты до batch_images изображений в общие пакеты.
+    def __init__(self, ocr, readers=PIPELINE_READERS, queue_size=PIPELINE_QUEUE, tile_size=TILE_SIZE,
+                 overlap=TILE_OVERLAP, cache=None, images=None, control=None, batch_images=REC_BATCH_IMAGES,
+                 batch_wait_ms=REC_BATCH_WAIT_MS, batch_crops=REC_BATCH_CROPS):
+        self.ocr = ocr
+        self.readers = max(1, readers)
+        self.queue_size = max(1, queue_size)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.cache = cache
+        self.images = images
+        self.control = control
+        self.batch_images = max(1, batch_images)
+        self.batch_wait = max(0, batch_wait_ms) / 1000
+        self.batch_crops = max(1, batch_crops)
+        self.queues = {}
+        self.busy = dict.fromkeys(STAGES, 0.0)
+
+    def depths(self):
+        # Текущая длина очереди перед каждой стадией
+        return {stage: q.qsize() for stage, q in self.queues.items()}
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.2)
+            except queue.Empty:
+                pass
+        return None
+
+    def _checkpoint(self):
+        # Пауза останавливает все стадии, а не только чтение
+        if self.control is not None:
+            self.control.checkpoint()
+
+    def _timed(self, stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            # Стадию чтения выполняют несколько потоков
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.busy[stage] += elapsed
+
+    def _decode_stage(self):
+        # Каждое изображение, которое не дойдёт до распознавания, учитывается в _awaiting ровно один раз
+        while True:
+            Imgpath = self._get(self.queues["decode"])
+            if Imgpath is None:
+                return
+            try:
+                self._checkpoint()
+                item = self._timed("decode", self._decode, Imgpath)
+            except JobCancelled:
+                return
+            except Exception as e:
+                print("Ошибка чтения", Imgpath, e)
+                item = None
+                self._put(self.out, (Imgpath, None))
+            if item is None:
+                self._skip_recognition()
+            else:
+                self._put(self.queues["detect"], item)
+
+    def _decode(self, Imgpath):
+        # Изображение для следующей стадии или None, если результат уже готов
+        data = read_bytes(Imgpath)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(data, self.tile_size, self.overlap)
+            found, result_dic = self.cache.get(key)
+            if found:
+                self._put(self.out, (Imgpath, result_dic))
+                return None
+        Iw, Ih = image_size(Imgpath)
+        if Ih > MIN_IMAGE_SIDE and Iw > MIN_IMAGE_SIDE:
+            # Для мозаичного распознавания большие BMP/TIFF не декодируются целиком
+            source = open_source(Imgpath) if self.tile_size and max(Ih, Iw) > self.tile_size else None
+            img = source or (self.images.get(Imgpath, data) if self.images is not None else decode_image(data))
+            return Imgpath, key, img
+        print('Размер изображения', Imgpath, 'очень мал для распознавания.')
+        self._finish(Imgpath, key, None)
+        return None
+
+    def _detect_stage(self):
+        while True:
+            item = self._get(self.queues["detect"])
+            if item is None:
+                return
+            Imgpath, key, img = item
+            try:
+                self._checkpoint()
+                Ih, Iw = img.shape[:2]
+                if self.tile_size and max(Ih, Iw) > self.tile_size:
+                    # Большие карты: обнаружение по фрагментам здесь, распознавание всех
+                    # фрагментов - на общей стадии, склейка - при постобработке
+                    item = (Imgpath, key, Iw, Ih) + self._detect_tiles(img)
+                else:
+                    dt_boxes, crops = self._timed("detect", detect_text, self.ocr, img)
+                    item = (Imgpath, key, Iw, Ih, dt_boxes, crops, None)
+            except JobCancelled:
+                return
+            except Exception as e:
+                print("Ошибка обнаружения", Imgpath, e)
+                self._skip_recognition()
+                self._put(self.out, (Imgpath, None))
+                continue
+            self._put(self.queues["recognize"], item)
+
+    def _detect_tiles(self, img):
+        source = as_source(img)
+        Ih, Iw = source.height, source.width
+        overlap = min(self.overlap, self.tile_size // 2)
+        tiles = tile_grid(Iw, Ih, self.tile_size, overlap)
+        dt_boxes, crops = [], []
+        for tile in tiles:
+            self._checkpoint()
+            tile_boxes, tile_crops = self._timed("detect", detect_tile, self.ocr, source.read(*tile[:4]), tile)
+            dt_boxes.extend(tile_boxes)
+            crops.extend(tile_crops)
+        return dt_boxes, crops, (tiles, overlap)
+
+    def _skip_recognition(self):
+        # Изображение не дойдёт до распознавания (готово из кэша, мало, ошибка)
+        with self._lock:
+            self._awaiting -= 1
+
+    def _recognize_stage(self):
+        # Пакет отправляется, когда набрано batch_images изображений или batch_crops фрагментов,
+        # когда больше ни одно изображение не придёт или очередь пуста дольше batch_wait:
+        # при просмотре по мере готовности первые результаты не ждут полного пакета
+        batch, crops, idle = [], 0, False
+        while not self._stop.is_set():
+            with self._lock:
+                last = self._awaiting == 0
+            if batch and (len(batch) >= self.batch_images or crops >= self.batch_crops or last or idle):
+                try:
+                    self._checkpoint()
+                    self._recognize(batch)
+                except JobCancelled:
+                    return
+                batch, crops, idle = [], 0, False
+                continue
+            try:
+                item = self.queues["recognize"].get(timeout=self.batch_wait if batch else 0.2)
+            except queue.Empty:
+                idle = bool(batch)
+                continue
+            with self._lock:
+                self._awaiting -= 1
+            batch.append(item)
+            crops += len(item[5])
+
+    def _recognize(self, batch):
+        try:
+            raw_batch = self._timed("recognize", recognize_batch, self.ocr,
+                                    [(dt_boxes, crops) for _, _, _, _, dt_boxes, crops, _ in batch])
+        except Exception as e:
+            print("Ошибка распознавания", ", ".join(item[0] for item in batch), e)
+            for item in batch:
+                self._put(self.out, (item[0], None))
+            return
+        for (Imgpath, key, Iw, Ih, _, _, tiling), raw_results in zip(batch, raw_batch):
+            self._put(self.queues["postprocess"], (Imgpath, key, Iw, Ih, raw_results, tiling))
+
+    def _postprocess_stage(self):
+        while True:
+            item = self._get(self.queues["postprocess"])
+            if item is None:
+                return
+            Imgpath, key, Iw, Ih, raw_results, tiling = item
+            try:
+                if tiling is not None:
+                    raw_results = self._timed("postprocess", suppress_duplicates, raw_results, *tiling)
+                self._finish(Imgpath, key, self._timed("postprocess", postprocess, raw_results, Iw, Ih))
+            except Exception as e:
+                print("Ошибка обработки", Imgpath, e)
+                self._put(self.out, (Imgpath, None))
+
+    def _finish(self, Imgpath, key, result_dic):
+        if self.cache is not None and key is not None:
+            self.cache.put(key, result_dic)
+        self._put(self.out, (Imgpath, result_dic))
+
+    def run(self, imgs_pathsList):
+        # Результаты выдаются по мере готовности, порядок может отличаться от исходного
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._awaiting = len(imgs_pathsList)
+        self.queues = {"decode": queue.Queue()}
+        for stage in STAGES[1:]:
+            self.queues[stage] = queue.Queue(self.queue_size)
+        self.out = queue.Queue()
+        for Imgpath in imgs_pathsList:
+            self.queues["decode"].put(Imgpath)
+        workers = [self._decode_stage] * self.readers + [self._detect_stage, self._recognize_stage,
+                                                         self._postprocess_stage]
+        threads = [threading.Thread(target=target, daemon=True) for target in workers]
+        for thread in threads:
+            thread.start()
+        try:
+            remaining = len(imgs_pathsList)
+            while remaining:
+                try:
+                    yield self.out.get(timeout=0.2)
+                    remaining -= 1
+                except queue.Empty:
+                    if self.control is not None and self.control.cancelled:
+                        return
+        finally:
+            self._stop.set()
@@ -0,0 +1,124 @@
+import os
+import json
+import tempfile
+import threading
+import multiprocessing as mp
+from OcrEngine import create_ocr, ocr_image, TILE_SIZE, TILE_OVERLAP, JobCancelled
+
+# Число процессов и потоков на процесс можно задать через переменные окружения
+# (0 - процессов по числу ядер, 1 - распознавание в одном процессе)
+DEFAULT_PROCESSES = int(os.environ.get("LOCMAP_OCR_PROCESSES", 0))
+DEFAULT_THREADS = int(os.environ.get("LOCMAP_OCR_THREADS", 0))
+# Способ запуска процессов: spawn - каждый процесс сам загружает модели;
+# forkserver - модели загружает один сервер процессов, а процессы пула порождаются от него
+START_METHOD = os.environ.get("LOCMAP_OCR_START", "spawn")
+
+_ocr = None
+_ocr_config = None
+# В главном процессе: параметры моделей, с которыми запущен сервер процессов
+_forkserver_config = None
+_forkserver_lock = threading.Lock()
+_tile = (TILE_SIZE, TILE_OVERLAP)
+_cache = None
+
+
+def forkserver_config_path(pid):
+    # Параметры моделей для сервера процессов; pid - процесс, который запускает сервер
+    return os.path.join(tempfile.gettempdir(), f"locmap-forkserver-{pid}.json")
+
+
+def _init_worker(cpu_threads, ocr_kwargs, tile, cache, config=None):
+    global _ocr, _tile, _cache
+    # Модели, загруженные сервером процессов, используются, если они с теми же параметрами
+    if _ocr is None or config is None or config != _ocr_config:
+        _ocr = create_ocr(show_log=False, cpu_threads=cpu_threads, **ocr_kwargs)
+    _tile = tile
+    _cache = cache
+
+
+def _ocr_task(Imgpath):
+    try:
+        return Imgpath, ocr_image(_ocr, Imgpath, *_tile, cache=_cache)
+    except Exception as e:
+        print("Ошибка распознавания", Imgpath, e)
+        return Imgpath, None
+
+
+class OcrPool:
+    # Пул процессов, в каждом из которых свой экземпляр PaddleOCR.
+    # В режиме forkserver модели один раз загружает сервер процессов, процессы пула
+    # порождаются от него за миллисекунды и не держат собственных копий весов
+    def __init__(self, processes=DEFAULT_PROCESSES, cpu_threads=DEFAULT_THREADS,
+                 tile_size=TILE_SIZE, overlap=TILE_OVERLAP, cache=None, start_method=START_METHOD, **ocr_kwargs):
+        global _forkserver_config
+        self.processes = max(1, processes or os.cpu_count())
+        self.cpu_threads = cpu_threads or max(1, (os.cpu_count() or 1) // self.processes)
+        if start_method not in mp.get_all_start_methods():
+            print("Способ запуска процессов", start_method, "недоступен, используется spawn")
+            start_method = "spawn"
+        self.start_method = start_method
+        config = None
+        if start_method == "forkserver":
+            config = json.dumps(dict(ocr_kwargs, cpu_threads=self.cpu_threads), sort_keys=True, default=str)
+        ctx = mp.get_context(start_method)
+        initargs = (self.cpu_threads, ocr_kwargs, (tile_size, overlap), cache, config)
+        if config is None:
+            self.pool = ctx.Pool(self.processes, initializer=_init_worker, initargs=initargs)
+            return
+        # Сервер процессов запускается при создании первого пула и читает параметры из файла.
+        # Pool() возвращается, когда процессы уже порождены, то есть сервер файл прочитал
+        with _forkserver_lock:
+            if _forkserver_config is None:
+                path = forkserver_config_path(os.getpid())
+                with open(path, 'w', encoding='utf-8') as file:
+                    file.write(config)
+                ctx.set_forkserver_preload(["OcrForkServer"])
+                try:
+                    self.pool = ctx.Pool(self.processes, initializer=_init_worker, initargs=initargs)
+                finally:
+                    os.remove(path)
+                _forkserver_config = config
+                return
+        if config != _forkserver_config:
+            print("Сервер процессов загрузил модели с другими параметрами, процессы пула загрузят свои")
+        self.pool = ctx.Pool(self.processes, initializer=_init_worker, initargs=initargs)
+
+    def imap(self, imgs_pathsList, control=None):
+        # Результаты возвращаются по мере готовности, а не в порядке списка.
+        # С control задачи выдаются пулу не более чем по две на процесс,
+        # так что пауза останавливает подачу новых изображений
+        if control is None:
+            yield from self.pool.imap_unordered(_ocr_task, imgs_pathsList, chunksize=1)
+            return
+        slots = threading.Semaphore(2 * self.processes)
+
+        def feed():
+            for Imgpath in imgs_pathsList:
+                slots.acquire()
+                try:
+                    control.checkpoint()
+                except JobCancelled:
+                    return
+                yield Imgpath
+
+        try:
+            for result in self.pool.imap_unordered(_ocr_task, feed(), chunksize=1):
+                slots.release()
+                yield result
+        finally:
+            # Подающий поток пула не должен остаться заблокированным
+            slots.release(len(imgs_pathsList))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.terminate()
@@ -0,0 +1,96 @@
+import struct
+import numpy as np
+
+_HEADER = struct.Struct("<II")
+
+
+class ImageResults:
+    # Результаты распознавания одного изображения в компактном виде: рамки (N, 4, 2)
+    # и вероятности во float32, тексты - общий буфер UTF-8 со смещениями.
+    # Элемент res[i] совместим с прежним форматом [[[x, y] x4], (text, prob)].
+    __slots__ = ("boxes", "scores", "text_buffer", "text_offsets")
+
+    def __init__(self, boxes, scores, text_buffer, text_offsets):
+        self.boxes = boxes
+        self.scores = scores
+        self.text_buffer = text_buffer
+        self.text_offsets = text_offsets
+
+    @classmethod
+    def from_arrays(cls, boxes, texts, scores):
+        encoded = [text.encode('utf-8') for text in texts]
+        text_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        text_offsets[1:] = np.cumsum([len(e) for e in encoded])
+        text_buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(np.asarray(boxes, dtype=np.float32).reshape(-1, 4, 2),
+                   np.asarray(scores, dtype=np.float32).reshape(-1), text_buffer, text_offsets)
+
+    @classmethod
+    def from_list(cls, results):
+        return cls.from_arrays([res[0] for res in results], [res[1][0] for res in results],
+                               [res[1][1] for res in results])
+
+    def __len__(self):
+        return len(self.scores)
+
+    def text(self, i):
+        return self.text_buffer[self.text_offsets[i]:self.text_offsets[i + 1]].tobytes().decode('utf-8')
+
+    @property
+    def texts(self):
+        data = self.text_buffer.tobytes()
+        offsets = self.text_offsets.tolist()
+        return [data[a:b].decode('utf-8') for a, b in zip(offsets, offsets[1:])]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return [self.boxes[i].tolist(), (self.text(i), float(self.scores[i]))]
+
+    def __iter__(self):
+        for box, text, score in zip(self.boxes.tolist(), self.texts, self.scores.tolist()):
+            yield [box, (text, score)]
+
+    def __repr__(self):
+        return f"ImageResults({len(self)})"
+
+    def to_list(self):
+        return list(self)
+
+    def select(self, index):
+        # Подмножество результатов по маске или списку индексов
+        index = np.flatnonzero(index) if np.asarray(index).dtype == bool else np.asarray(index, dtype=np.int64)
+        texts = self.texts
+        return ImageResults.from_arrays(self.boxes[index], [texts[i] for i in index], self.scores[index])
+
+    @staticmethod
+    def concat(parts):
+        parts = [p for p in parts if p is not None]
+        return ImageResults.from_arrays(np.concatenate([p.boxes for p in parts]) if parts else np.empty((0, 4, 2)),
+                                        [t for p in parts for t in p.texts],
+                                        np.concatenate([p.scores for p in parts]) if parts else [])
+
+    @property
+    def bboxes(self):
+        # Описанные прямоугольники (x1, y1, x2, y2)
+        return np.concatenate([self.boxes.min(1), self.boxes.max(1)], axis=1)
+
+    def to_bytes(self):
+        return b"".join([_HEADER.pack(len(self), len(self.text_buffer)),
+                         self.boxes.astype('<f4').tobytes(), self.scores.astype('<f4').tobytes(),
+                         self.text_offsets.astype('<i8').tobytes(), self.text_buffer.tobytes()])
+
+    @classmethod
+    def from_bytes(cls, data):
+        n, nbytes = _HEADER.unpack_from(data)
+        pos = _HEADER.size
+        boxes = np.frombuffer(data, dtype='<f4', count=n * 8, offset=pos).reshape(n, 4, 2)
+        pos += n * 32
+        scores = np.frombuffer(data, dtype='<f4', count=n, offset=pos)
+        pos += n * 4
+        text_offsets = np.frombuffer(data, dtype='<i8', count=n + 1, offset=pos)
+        pos += (n + 1) * 8
+        text_buffer = np.frombuffer(data, dtype=np.uint8, count=nbytes, offset=pos)
+        return cls(boxes, scores, text_buffer, text_offsets)
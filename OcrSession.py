@@ -0,0 +1,112 @@
+import os
+import json
+import struct
+import numpy as np
+from OcrResults import ImageResults
+
+SESSION_EXTENSION = ".locmap"
+_MAGIC = b"LOCMAPS1"
+# Магия и длина JSON-заголовка; массивы идут после заголовка с выравниванием
+_HEADER = struct.Struct("<8sQ")
+_ALIGN = 64
+_VERSION = 1
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def fingerprint(path):
+    # Размер и время изменения файла; None, если файла нет
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def copy_results(results_dic):
+    # Результаты в обычной памяти, без ссылок на отображённый файл сеанса
+    return {Imgpath: ImageResults(res.boxes.copy(), res.scores.copy(), res.text_buffer.copy(), res.text_offsets.copy())
+            for Imgpath, res in results_dic.items()}
+
+
+def save_session(path, imgs_pathsList, results_dic, view=None):
+    # Файл сеанса: JSON-заголовок (изображения, их отпечатки, состояние просмотра)
+    # и результаты всех изображений общими массивами, как в ImageResults.
+    # Пишется во временный файл и заменяет прежний целиком
+    parts = [results_dic.get(Imgpath) for Imgpath in imgs_pathsList]
+    present = np.array([res is not None for res in parts], dtype=np.uint8)
+    result_offsets = np.zeros(len(imgs_pathsList) + 1, dtype='<i8')
+    result_offsets[1:] = np.cumsum([len(res) if res is not None else 0 for res in parts])
+    parts = [res for res in parts if res is not None]
+    texts = [res.text_buffer[res.text_offsets[0]:res.text_offsets[-1]] for res in parts]
+    text_lengths = [np.diff(res.text_offsets) for res in parts]
+    text_offsets = np.zeros(int(result_offsets[-1]) + 1, dtype='<i8')
+    if text_lengths:
+        text_offsets[1:] = np.cumsum(np.concatenate(text_lengths))
+    arrays = {
+        "present": present,
+        "result_offsets": result_offsets,
+        "boxes": np.concatenate([res.boxes for res in parts] or [np.empty((0, 4, 2))]).astype('<f4'),
+        "scores": np.concatenate([res.scores for res in parts] or [np.empty(0)]).astype('<f4'),
+        "text_offsets": text_offsets,
+        "text_buffer": np.concatenate(texts or [np.empty(0)]).astype(np.uint8),
+    }
+    layout, pos = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {"offset": pos, "dtype": array.dtype.str, "shape": list(array.shape)}
+        pos = _aligned(pos + array.nbytes)
+    header = json.dumps({"version": _VERSION, "images": list(imgs_pathsList),
+                         "fingerprints": [fingerprint(Imgpath) for Imgpath in imgs_pathsList],
+                         "view": view or {}, "arrays": layout}, ensure_ascii=False).encode('utf-8')
+    start = _aligned(_HEADER.size + len(header))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(_HEADER.pack(_MAGIC, len(header)))
+        file.write(header)
+        for name, array in arrays.items():
+            file.seek(start + layout[name]["offset"])
+            file.write(array.tobytes())
+        file.truncate(start + pos)
+    os.replace(tmp_path, path)
+
+
+def load_session(path):
+    # Массивы результатов не читаются, а отображаются в память: результаты изображений -
+    # это срезы общих массивов. Возвращает список изображений, словарь результатов,
+    # состояние просмотра и изображения, которые изменились или пропали после сохранения
+    with open(path, 'rb') as file:
+        magic, header_size = _HEADER.unpack(file.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError(f"Файл не является сеансом LocMap: {path}")
+        header = json.loads(file.read(header_size).decode('utf-8'))
+    if header.get("version") != _VERSION:
+        raise ValueError(f"Неподдерживаемая версия сеанса {header.get('version')}: {path}")
+    start = _aligned(_HEADER.size + header_size)
+    # Срезы обычного массива создаются быстрее срезов memmap; отображение живёт, пока есть срезы
+    data = np.memmap(path, dtype=np.uint8, mode='r').view(np.ndarray)
+
+    def array(name):
+        spec = header["arrays"][name]
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        offset = start + spec["offset"]
+        return data[offset:offset + count * dtype.itemsize].view(dtype).reshape(spec["shape"])
+
+    present = array("present")
+    result_offsets = array("result_offsets").tolist()
+    boxes, scores = array("boxes"), array("scores")
+    text_offsets, text_buffer = array("text_offsets"), array("text_buffer")
+    text_starts = text_offsets[result_offsets].tolist()
+    imgs_pathsList = header["images"]
+    results_dic = {}
+    for i, Imgpath in enumerate(imgs_pathsList):
+        if not present[i]:
+            continue
+        a, b = result_offsets[i], result_offsets[i + 1]
+        t0, t1 = text_starts[i], text_starts[i + 1]
+        results_dic[Imgpath] = ImageResults(boxes[a:b], scores[a:b], text_buffer[t0:t1], text_offsets[a:b + 1] - t0)
+    changed = [Imgpath for Imgpath, saved in zip(imgs_pathsList, header["fingerprints"])
+               if fingerprint(Imgpath) != saved]
+    return imgs_pathsList, results_dic, header["view"], changed
@@ -0,0 +1,130 @@
+import math
+import numpy as np
+
+# Число элементов в узле R-дерева
+NODE_SIZE = 16
+
+
+def points_in_polygon(points, polygon):
+    # Чётно-нечётное правило для массива точек (N, 2) и многоугольника (M, 2)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    for (ax, ay), (bx, by) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (ay > y) != (by > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xcross = ax + (y - ay) * (bx - ax) / (by - ay)
+        inside ^= crosses & (x < xcross)
+    return inside
+
+
+class BoxIndex:
+    # Пространственный индекс результатов одного изображения.
+    # Описанные прямоугольники рамок упакованы в R-дерево (Sort-Tile-Recursive):
+    # листья - рамки, отсортированные полосами по x и внутри полос по y, каждый
+    # следующий уровень - прямоугольники групп по NODE_SIZE элементов. Запрос
+    # по прямоугольнику спускается только в пересекающие его узлы.
+    # Для поиска ближайших и по радиусу по центрам рамок строится cKDTree
+    # (scipy загружается при первом таком запросе).
+    def __init__(self, bboxes, node_size=NODE_SIZE):
+        self.bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+        self.centres = (self.bboxes[:, :2] + self.bboxes[:, 2:]) / 2
+        self.node_size = node_size
+        self._kdtree = None
+        self._order = self._str_order()
+        level = self.bboxes[self._order]
+        self._levels = [level]
+        while len(level) > node_size:
+            starts = np.arange(0, len(level), node_size)
+            level = np.concatenate([np.minimum.reduceat(level[:, :2], starts),
+                                    np.maximum.reduceat(level[:, 2:], starts)], axis=1)
+            self._levels.append(level)
+
+    @classmethod
+    def from_results(cls, results):
+        return cls(results.bboxes if results is not None and len(results) else np.empty((0, 4)))
+
+    def _str_order(self):
+        n = len(self.bboxes)
+        if n <= self.node_size:
+            return np.arange(n)
+        slice_size = self.node_size * math.ceil(math.sqrt(n / self.node_size))
+        by_x = np.argsort(self.centres[:, 0], kind="stable")
+        slices = np.arange(n) // slice_size
+        return by_x[np.lexsort((self.centres[by_x, 1], slices))]
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def query_rect(self, x0, y0, x1, y1):
+        # Номера рамок, пересекающих прямоугольник, по возрастанию
+        if len(self.bboxes) == 0:
+            return np.empty(0, dtype=np.int64)
+        nodes = np.arange(len(self._levels[-1]))
+        for k in range(len(self._levels) - 1, -1, -1):
+            b = self._levels[k][nodes]
+            nodes = nodes[(b[:, 0] <= x1) & (b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 3] >= y0)]
+            if k > 0:
+                nodes = (nodes[:, None] * self.node_size + np.arange(self.node_size)).ravel()
+                nodes = nodes[nodes < len(self._levels[k - 1])]
+        return np.sort(self._order[nodes])
+
+    def hit(self, x, y):
+        # Рамка под точкой; из нескольких - самая маленькая. -1, если ничего нет
+        found = self.query_rect(x, y, x, y)
+        if len(found) == 0:
+            return -1
+        b = self.bboxes[found]
+        return int(found[np.argmin((b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]))])
+
+    def nearest_box(self, x, y, max_distance):
+        # Рамка, ближайшая к точке по расстоянию до её края, не дальше max_distance; -1, если нет
+        found = self.query_rect(x - max_distance, y - max_distance, x + max_distance, y + max_distance)
+        if len(found) == 0:
+            return -1
+        b = self.bboxes[found]
+        dx = np.maximum(np.maximum(b[:, 0] - x, x - b[:, 2]), 0)
+        dy = np.maximum(np.maximum(b[:, 1] - y, y - b[:, 3]), 0)
+        distances = np.hypot(dx, dy)
+        k = np.argmin(distances)
+        return int(found[k]) if distances[k] <= max_distance else -1
+
+    def overlapping(self, i):
+        # Рамки, пересекающиеся с рамкой i, кроме неё самой
+        found = self.query_rect(*self.bboxes[i].tolist())
+        return found[found != i]
+
+    @property
+    def kdtree(self):
+        if self._kdtree is None:
+            from scipy.spatial import cKDTree
+            self._kdtree = cKDTree(self.centres)
+        return self._kdtree
+
+    def nearest(self, x, y, k=1, max_distance=np.inf):
+        # k ближайших центров рамок: (номера, расстояния) по возрастанию расстояния
+        if len(self.bboxes) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        distances, found = self.kdtree.query((x, y), k=min(k, len(self.bboxes)), distance_upper_bound=max_distance)
+        distances, found = np.atleast_1d(distances), np.atleast_1d(found)
+        valid = np.isfinite(distances)
+        return found[valid].astype(np.int64), distances[valid]
+
+    def within_radius(self, x, y, radius):
+        # Рамки с центром не дальше radius от точки, по возрастанию номера
+        if len(self.bboxes) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.asarray(self.kdtree.query_ball_point((x, y), radius), dtype=np.int64))
+
+    def within_rect(self, x0, y0, x1, y1):
+        # Рамки с центром внутри прямоугольника
+        found = self.query_rect(x0, y0, x1, y1)
+        c = self.centres[found]
+        return found[(c[:, 0] >= x0) & (c[:, 0] <= x1) & (c[:, 1] >= y0) & (c[:, 1] <= y1)]
+
+    def within_polygon(self, polygon):
+        # Рамки с центром внутри многоугольника (M, 2)
+        polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        found = self.within_rect(*polygon.min(0), *polygon.max(0))
+        return found[points_in_polygon(self.centres[found], polygon)]
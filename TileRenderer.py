@@ -0,0 +1,122 @@
+import os
+import math
+import threading
+import cv2
+import numpy as np
+from PyQt6.QtCore import QThread, pyqtSignal, QRectF
+from PyQt6.QtGui import QImage
+from ImageStore import as_source
+
+# Сторона фрагмента пирамиды, px
+TILE_PX = int(os.environ.get("LOCMAP_TILE_PX", 512))
+# Изображения, у которых большая сторона не меньше этой, показываются через пирамиду
+PYRAMID_MIN_SIDE = int(os.environ.get("LOCMAP_PYRAMID_MIN_SIDE", 4096))
+# Сколько готовых фрагментов держать в памяти холста
+TILE_CACHE = int(os.environ.get("LOCMAP_TILE_CACHE", 256))
+# Наибольшая сторона обзорного уровня, который строится сразу, и высота полосы для него
+PREVIEW_SIDE = 1024
+PREVIEW_BAND = 512
+
+
+def to_qimage(cvimg):
+    # QImage в формате RGB32 владеет своими данными и переводится в QPixmap без преобразования
+    height, width, depth = cvimg.shape
+    return QImage(cvimg.data, width, height, width * depth, QImage.Format.Format_BGR888).convertToFormat(QImage.Format.Format_RGB32)
+
+
+class TilePyramid:
+    # Уровни изображения, каждый вдвое меньше предыдущего, разрезанные на фрагменты.
+    # Фрагмент любого уровня читается из источника только в пределах своего окна
+    # и уменьшается до размера уровня, так что файлы, отображаемые в память,
+    # никогда не загружаются целиком. Обзорный уровень строится сразу по полосам,
+    # им закрываются ещё не готовые фрагменты.
+    def __init__(self, img, tile=TILE_PX):
+        self.source = as_source(img)
+        self.height, self.width = self.source.height, self.source.width
+        self.tile = tile
+        self.preview_level = max(0, math.ceil(math.log2(max(self.width, self.height) / PREVIEW_SIDE)))
+        self.preview = to_qimage(self.build_preview())
+
+    def build_preview(self):
+        pw, ph = self.level_size(self.preview_level)
+        band = max(PREVIEW_BAND, 64 * 2 ** self.preview_level)
+        rows = []
+        for y0 in range(0, self.height, band):
+            y1 = min(self.height, y0 + band)
+            rows.append(cv2.resize(self.source.read(0, y0, self.width, y1),
+                                   (pw, max(1, round((y1 - y0) * ph / self.height))), interpolation=cv2.INTER_AREA))
+        preview = np.concatenate(rows)
+        if preview.shape[0] != ph:
+            preview = cv2.resize(preview, (pw, ph), interpolation=cv2.INTER_AREA)
+        return preview
+
+    def level_size(self, k):
+        return max(1, round(self.width / 2 ** k)), max(1, round(self.height / 2 ** k))
+
+    def level_for(self, scale):
+        # Ближайший уровень, разрешение которого не меньше нужного при этом масштабе
+        k = math.floor(math.log2(1 / scale)) if scale < 1 else 0
+        return max(0, min(k, self.preview_level))
+
+    def tiles_in(self, k, x0, y0, x1, y1):
+        # Фрагменты уровня k, пересекающие прямоугольник в координатах изображения
+        lw, lh = self.level_size(k)
+        fx, fy = lw / self.width, lh / self.height
+        tx0, ty0 = max(0, int(x0 * fx) // self.tile), max(0, int(y0 * fy) // self.tile)
+        tx1 = min((lw - 1) // self.tile, int(x1 * fx) // self.tile)
+        ty1 = min((lh - 1) // self.tile, int(y1 * fy) // self.tile)
+        return [(k, tx, ty) for ty in range(ty0, ty1 + 1) for tx in range(tx0, tx1 + 1)]
+
+    def tile_rects(self, k, tx, ty):
+        # (прямоугольник в координатах изображения, прямоугольник на уровне k)
+        lw, lh = self.level_size(k)
+        x, y = tx * self.tile, ty * self.tile
+        w, h = min(self.tile, lw - x), min(self.tile, lh - y)
+        fx, fy = self.width / lw, self.height / lh
+        return QRectF(x * fx, y * fy, w * fx, h * fy), QRectF(x, y, w, h)
+
+    def tile_image(self, k, tx, ty):
+        target, source = self.tile_rects(k, tx, ty)
+        pixels = self.source.read(math.floor(target.left()), math.floor(target.top()),
+                                  math.ceil(target.right()), math.ceil(target.bottom()))
+        if k > 0:
+            pixels = cv2.resize(pixels, (int(source.width()), int(source.height())), interpolation=cv2.INTER_AREA)
+        return to_qimage(np.ascontiguousarray(pixels))
+
+
+class TileLoader(QThread):
+    # Готовит фрагменты пирамиды в фоновом потоке; новый запрос заменяет невыполненный
+    tileReady = pyqtSignal(object, QImage)
+
+    def __init__(self):
+        super(TileLoader, self).__init__()
+        self.pyramid = None
+        self.pending = []
+        self.handle = 0
+        self.cond = threading.Condition()
+
+    def request(self, pyramid, keys):
+        with self.cond:
+            self.pyramid = pyramid
+            self.pending = list(keys)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.handle = -1
+            self.cond.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and self.handle == 0:
+                    self.cond.wait()
+                if self.handle != 0:
+                    return
+                pyramid = self.pyramid
+                key = self.pending.pop(0)
+            try:
+                self.tileReady.emit((id(pyramid),) + key, pyramid.tile_image(*key))
+            except Exception as e:
+                print("TileLoader:", e)